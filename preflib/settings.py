@@ -107,6 +107,10 @@ STATIC_URL = "/static/"
 
 LOGIN_URL = "/login"
 
+# Engine answering the data search: "database" queries the search facts table, "columnar"
+# filters an in-memory copy of it loaded once per process
+SEARCH_ENGINE = "database"
+
 # Auto primary keys
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
@@ -7,5 +7,10 @@ admin.site.register(DataSet)
 admin.site.register(DataFile)
 admin.site.register(Metadata)
 admin.site.register(DataProperty)
+admin.site.register(DataFileFacts)
+admin.site.register(MetadataSearchBounds)
+admin.site.register(MetadataComputation)
+admin.site.register(SiteStatistics)
+admin.site.register(DataGeneration)
 admin.site.register(Paper)
 admin.site.register(Log)
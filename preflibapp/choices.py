@@ -42,3 +42,14 @@ METADATACATEGORIES = [
 ]
 
 SEARCHWIDGETS = [("ternary", "ternary choices"), ("range", "range")]
+
+COSTTIERS = [(0, "cheap"), (1, "moderate"), (2, "expensive")]
+
+COMPUTATIONSTATUSES = [
+    ("done", "done"),
+    ("timed_out", "timed out"),
+    ("out_of_memory", "out of memory"),
+    ("failed", "failed"),
+    ("derived", "derived"),
+    ("pruned", "pruned"),
+]
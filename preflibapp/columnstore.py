@@ -0,0 +1,119 @@
+from .models import *
+from .generations import get_generation
+
+from threading import Lock
+
+import numpy as np
+
+
+# In-memory copy of the search facts table, with one array per metadata and one boolean
+# bitmap per data type and modification type. Rows are sorted as the search results.
+class ColumnStore:
+    def __init__(self, stamp):
+        self.stamp = stamp
+        rows = list(
+            DataFileFacts.objects.order_by(
+                "datafile__file_name", "datafile__data_type"
+            ).values_list("datafile_id", "data_type", "modification_type", "values")
+        )
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+
+        data_types = np.array([row[1] for row in rows], dtype=object)
+        self.data_types = {t: data_types == t for t, _ in DATATYPES}
+        modification_types = np.array([row[2] for row in rows], dtype=object)
+        self.modification_types = {
+            mt: modification_types == mt for mt, _ in MODIFICATIONTYPES
+        }
+
+        # Missing values are NaN, booleans are stored as 0 and 1
+        self.columns = {}
+        for index, row in enumerate(rows):
+            for short_name, value in row[3].items():
+                if short_name not in self.columns:
+                    self.columns[short_name] = np.full(len(rows), np.nan)
+                self.columns[short_name][index] = float(value)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Returns the boolean mask of the rows matching the filters
+    def mask(self, filters):
+        mask = np.zeros(len(self), dtype=bool)
+        for data_type in filters["data_types"]:
+            if data_type in self.data_types:
+                mask |= self.data_types[data_type]
+
+        if filters["modification_types"] is not None:
+            modification_mask = np.zeros(len(self), dtype=bool)
+            for modification_type in filters["modification_types"]:
+                if modification_type in self.modification_types:
+                    modification_mask |= self.modification_types[modification_type]
+            mask &= modification_mask
+
+        # Files for which a metadata has not been computed are never filtered out by it
+        for short_name, value in filters["ternary"].items():
+            column = self.columns.get(short_name)
+            if column is None:
+                if value:
+                    mask[:] = False
+            elif value:
+                mask &= column == 1
+            else:
+                mask &= column != 1
+
+        for short_name, (min_value, max_value) in filters["range"].items():
+            column = self.columns.get(short_name)
+            if column is not None:
+                mask &= np.isnan(column) | (
+                    (column >= min_value) & (column <= max_value)
+                )
+        return mask
+
+    # Returns the primary keys of the data files matching the filters, in the search order
+    def search(self, filters):
+        return self.ids[self.mask(filters)].tolist()
+
+    # Returns the facet counts of the data files matching the filters
+    def facets(self, filters, ternary_names, histogram_edges):
+        mask = self.mask(filters)
+        facets = {
+            "total": int(mask.sum()),
+            "data_types": {
+                t: int((bitmap & mask).sum()) for t, bitmap in self.data_types.items()
+            },
+            "modification_types": {
+                mt: int((bitmap & mask).sum())
+                for mt, bitmap in self.modification_types.items()
+            },
+            "ternary": {},
+            "histograms": {},
+        }
+        for short_name in ternary_names:
+            column = self.columns.get(short_name)
+            facets["ternary"][short_name] = (
+                0 if column is None else int(((column == 1) & mask).sum())
+            )
+        for short_name, edges in histogram_edges.items():
+            column = self.columns.get(short_name)
+            values = [] if column is None else column[mask & ~np.isnan(column)]
+            facets["histograms"][short_name] = np.histogram(values, edges)[0].tolist()
+        return facets
+
+
+_column_store = None
+_column_store_lock = Lock()
+
+
+# Returns a stamp that changes whenever the search facts table is modified
+def get_data_stamp():
+    return get_generation()
+
+
+# Returns the column store of the process, reloading it if the data changed since it was loaded
+def get_column_store():
+    global _column_store
+    stamp = get_data_stamp()
+    with _column_store_lock:
+        if _column_store is None or _column_store.stamp != stamp:
+            _column_store = ColumnStore(stamp)
+        return _column_store
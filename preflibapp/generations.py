@@ -0,0 +1,87 @@
+from django.db.models import F
+from django.views.decorators.cache import cache_page
+
+from .models import *
+from .scripts import file_digest
+
+from functools import lru_cache, wraps
+
+import datetime
+import hashlib
+import os
+
+# The generation of all the data, pages depending on several datasets are cached per global
+# generation
+GLOBAL_GENERATION = "data"
+
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+# Returns the digest of all the templates and the time of their last modification. They
+# only change with a deployment, so they are read once per process.
+@lru_cache(maxsize=None)
+def get_templates_state():
+    digest = hashlib.sha256()
+    last_modified = None
+    for root, dirs, files in sorted(os.walk(TEMPLATES_DIR)):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(file_path, TEMPLATES_DIR).encode())
+            digest.update(file_digest(file_path).encode())
+            modified = datetime.datetime.fromtimestamp(
+                os.path.getmtime(file_path), tz=datetime.timezone.utc
+            )
+            if last_modified is None or modified > last_modified:
+                last_modified = modified
+    return digest.hexdigest(), last_modified
+
+
+def dataset_generation_key(series_number):
+    return "dataset-" + series_number
+
+
+def get_generation(key=GLOBAL_GENERATION):
+    generation = DataGeneration.objects.filter(key=key).values_list("value", flat=True)
+    return generation.first() or 0
+
+
+# Returns the generation and the time it was last increased, (0, None) if it never was
+def get_generation_state(key=GLOBAL_GENERATION):
+    state = DataGeneration.objects.filter(key=key).values_list("value", "updated_at")
+    return state.first() or (0, None)
+
+
+# Increases the global generation and the generations of the given datasets, so that the
+# cached pages depending on them are not served anymore
+def bump_generations(series_numbers=()):
+    keys = [GLOBAL_GENERATION] + [dataset_generation_key(n) for n in series_numbers]
+    for key in keys:
+        DataGeneration.objects.get_or_create(key=key)
+        DataGeneration.objects.filter(key=key).update(
+            value=F("value") + 1, updated_at=timezone.now()
+        )
+
+
+# Same as cache_page, except that the cache key includes a generation and the digest of the
+# templates. By default it is the global generation, if dataset_kwarg is set it is the
+# generation of the dataset whose series number is the argument of the view with that name.
+def cache_per_generation(timeout, dataset_kwarg=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if dataset_kwarg is None:
+                key = GLOBAL_GENERATION
+            else:
+                key = dataset_generation_key(kwargs[dataset_kwarg])
+            key_prefix = "{}.{}.{}".format(
+                key, get_generation(key), get_templates_state()[0][:16]
+            )
+            return cache_page(timeout, key_prefix=key_prefix)(view)(
+                request, *args, **kwargs
+            )
+
+        return wrapper
+
+    return decorator
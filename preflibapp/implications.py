@@ -0,0 +1,102 @@
+# Implications between the metadata, identified by their short names. They are used by
+# updatemetadata to settle values without calling the preflibtools functions.
+
+# The value of the "target" metadata is derived from the values of the metadata listed in
+# "uses", "derive" returning None when the values do not settle it.
+DERIVATIONS = [
+    {
+        "target": "isStrict",
+        "uses": ["largestIndif"],
+        "derive": lambda largest_indif: largest_indif == 1,
+    },
+    {
+        "target": "isComplete",
+        "uses": ["smallestBallot", "numAlt"],
+        "derive": lambda smallest_ballot, num_alt: smallest_ballot == num_alt,
+    },
+    {
+        "target": "largestBallot",
+        "uses": ["isComplete", "numAlt"],
+        "derive": lambda is_complete, num_alt: num_alt if is_complete else None,
+    },
+    {
+        "target": "maxNumIndif",
+        "uses": ["largestIndif"],
+        "derive": lambda largest_indif: 0 if largest_indif == 1 else None,
+    },
+    {
+        "target": "minNumIndif",
+        "uses": ["largestIndif"],
+        "derive": lambda largest_indif: 0 if largest_indif == 1 else None,
+    },
+    {
+        "target": "smallestIndif",
+        "uses": ["largestIndif"],
+        "derive": lambda largest_indif: 1 if largest_indif == 1 else None,
+    },
+]
+
+# The metadata is only computed when all the boolean metadata listed are True, it is pruned
+# (and set to False) otherwise. With the current metadata this never fires: isSP and isSC
+# only apply to soc files, which are strict and complete by definition. It is kept for the
+# metadata to come that apply to partial orders.
+PREREQUISITES = {
+    "isSP": ["isStrict", "isComplete"],
+    "isSC": ["isStrict", "isComplete"],
+}
+
+
+def dependencies(short_name):
+    res = list(PREREQUISITES.get(short_name, []))
+    for derivation in DERIVATIONS:
+        if derivation["target"] == short_name:
+            res.extend(derivation["uses"])
+    return res
+
+
+# All the metadata some implication refers to
+def used_short_names():
+    res = set()
+    for derivation in DERIVATIONS:
+        res.update(derivation["uses"])
+    for prerequisites in PREREQUISITES.values():
+        res.update(prerequisites)
+    return res
+
+
+# Orders the short names so that each one comes after the ones it depends on, keeping the
+# initial order otherwise
+def dependency_order(short_names):
+    short_names = list(short_names)
+    res = []
+    visiting = set()
+
+    def visit(short_name):
+        if short_name in res or short_name in visiting:
+            return
+        visiting.add(short_name)
+        for dependency in dependencies(short_name):
+            if dependency in short_names:
+                visit(dependency)
+        visiting.discard(short_name)
+        res.append(short_name)
+
+    for short_name in short_names:
+        visit(short_name)
+    return res
+
+
+# Returns the value of the metadata settled by the known values, None if nothing settles it
+def derive_value(short_name, known_values):
+    for derivation in DERIVATIONS:
+        if derivation["target"] == short_name and all(
+            m in known_values for m in derivation["uses"]
+        ):
+            value = derivation["derive"](*(known_values[m] for m in derivation["uses"]))
+            if value is not None:
+                return value
+    return None
+
+
+def is_pruned(short_name, known_values):
+    return any(known_values.get(m) is False for m in PREREQUISITES.get(short_name, []))
@@ -7,6 +7,8 @@ from preflibtools.instances.dataset import read_info_file
 import preflibapp
 
 from preflibapp.models import *
+from preflibapp.scripts import file_digest, file_preview, file_line_index
+from preflibapp.generations import bump_generations
 
 from preflibtools.instances.preflibinstance import (
     OrdinalInstance,
@@ -129,6 +131,9 @@ def add_dataset(file_path, tmp_dir, data_dir, keepzip, log):
                 )
 
             # We can finally create (or update) the datafile object in the database
+            num_lines, line_index = file_line_index(
+                os.path.join(data_dir, infos["abb"], file_name)
+            )
             datafile_obj, _ = DataFile.objects.update_or_create(
                 file_name=file_name,
                 defaults={
@@ -141,6 +146,14 @@ def add_dataset(file_path, tmp_dir, data_dir, keepzip, log):
                     "file_size": os.path.getsize(
                         os.path.join(data_dir, infos["abb"], file_name)
                     ),
+                    "content_digest": file_digest(
+                        os.path.join(data_dir, infos["abb"], file_name)
+                    ),
+                    "preview": file_preview(
+                        os.path.join(data_dir, infos["abb"], file_name)
+                    ),
+                    "num_lines": num_lines,
+                    "line_index": line_index,
                     "publication_date": file_info["publication_date"],
                 },
             )
@@ -157,6 +170,8 @@ def add_dataset(file_path, tmp_dir, data_dir, keepzip, log):
     if not keepzip:
         os.remove(file_path)
 
+    return dataset_obj
+
 
 class Command(BaseCommand):
     help = "Add datasets to database"
@@ -250,6 +265,7 @@ class Command(BaseCommand):
             # Starting the real stuff
             log.append("<p>Adding datasets</p>\n<ul>\n")
             start_time = timezone.now()
+            added_datasets = []
             for file_path in options["f"]:
                 # We only consider zip files
                 if os.path.splitext(file_path)[1] == ".zip":
@@ -259,9 +275,10 @@ class Command(BaseCommand):
                     log.append("\n\t<li>Dataset " + str(file_name) + "... ")
                     try:
                         # Actually adding the dataset
-                        add_dataset(
+                        dataset = add_dataset(
                             file_path, tmp_dir, data_dir, options["keepzip"], log
                         )
+                        added_datasets.append(dataset)
                         log.append(" ... done.</li>\n")
                     except Exception as e:
                         # If something happened, we log it and move on
@@ -282,6 +299,16 @@ class Command(BaseCommand):
             # Removing the tmp folder
             os.rmdir(tmp_dir)
 
+            # Refreshing the search tables and the statistics
+            if added_datasets:
+                management.call_command(
+                    "updatesearchfacts", abb=[ds.abbreviation for ds in added_datasets]
+                )
+            management.call_command("updatesearchbounds")
+            management.call_command("updatesitestatistics")
+            # The cached pages of the added datasets are outdated
+            bump_generations([ds.series_number for ds in added_datasets])
+
             # Finalizing the log
             log.append("</ul>\n<p>The datasets have been successfully added in ")
             log.append(str((timezone.now() - start_time).total_seconds() / 60))
@@ -290,6 +317,7 @@ class Command(BaseCommand):
             # Collecting the statics once everything has been done
             print("Finished, collecting statics")
             management.call_command("collectstatic", no_input=False)
+            management.call_command("compressstatic")
         except Exception as e:
             # If anything happened during the execution, we log it and move on
             log.append(
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+
+from preflibapp.columnstore import ColumnStore, get_data_stamp
+from preflibapp.models import *
+from preflibapp.search import filter_datafiles
+
+import statistics
+import random
+import time
+
+
+# Draws random search filters within the bounds of the sliders
+def random_filters(metadatas, rng):
+    filters = {
+        "data_types": [t[0] for t in DATATYPES if rng.random() < 0.8],
+        "modification_types": [mt[0] for mt in MODIFICATIONTYPES if rng.random() < 0.8],
+        "ternary": {},
+        "range": {},
+    }
+    for m in metadatas:
+        if m.search_widget == "ternary" and rng.random() < 0.3:
+            filters["ternary"][m.short_name] = rng.random() < 0.5
+        elif m.search_widget == "range" and rng.random() < 0.3:
+            try:
+                bounds = m.search_bounds
+            except MetadataSearchBounds.DoesNotExist:
+                continue
+            min_value = rng.randint(bounds.min_value, bounds.max_value)
+            max_value = rng.randint(min_value, bounds.max_value)
+            filters["range"][m.short_name] = (min_value, max_value)
+    return filters
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the database and the in-memory column store engines of the data search"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", type=int, default=100)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        metadatas = Metadata.objects.filter(
+            is_active=True, is_displayed=True
+        ).select_related("search_bounds")
+
+        column_store, load_time = timed(ColumnStore, get_data_stamp())
+        print(
+            "Column store with {} data files loaded in {:.1f} ms".format(
+                len(column_store), load_time * 1000
+            )
+        )
+
+        database_times = []
+        columnar_times = []
+        for _ in range(options["n"]):
+            filters = random_filters(metadatas, rng)
+            database_ids, database_time = timed(
+                lambda f: list(
+                    filter_datafiles(f)
+                    .order_by("file_name", "data_type")
+                    .values_list("pk", flat=True)
+                ),
+                filters,
+            )
+            columnar_ids, columnar_time = timed(column_store.search, filters)
+            if database_ids != columnar_ids:
+                print(
+                    "ERROR: the two engines disagree on the filters {}".format(filters)
+                )
+            database_times.append(database_time)
+            columnar_times.append(columnar_time)
+
+        for name, times in (("database", database_times), ("columnar", columnar_times)):
+            print(
+                "{:>10}: mean {:.3f} ms, median {:.3f} ms, max {:.3f} ms".format(
+                    name,
+                    statistics.mean(times) * 1000,
+                    statistics.median(times) * 1000,
+                    max(times) * 1000,
+                )
+            )
@@ -0,0 +1,199 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from preflibapp.scripts import file_digest
+
+from concurrent.futures import ProcessPoolExecutor
+
+import gzip
+import json
+import os
+import time
+
+# Brotli is in the requirements, without it only the gzip files are produced
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = ".compress-manifest.json"
+COMPRESSED_EXTENSIONS = (
+    ".html",
+    ".css",
+    ".js",
+    ".json",
+    ".svg",
+    ".txt",
+    ".xml",
+    ".csv",
+    ".soc",
+    ".soi",
+    ".toc",
+    ".toi",
+    ".cat",
+    ".wmd",
+    ".dat",
+)
+# Files without extension are distilled pages (data/search for instance)
+MIN_SIZE = 1024
+# The files are compressed by chunks. The highest compression levels are too slow for the
+# large data files, these get moderate levels.
+CHUNK_SIZE = 1 << 20
+LARGE_FILE_SIZE = 16 << 20
+GZIP_LEVELS = (9, 6)
+BROTLI_QUALITIES = (11, 5)
+
+
+def is_compressed(file_name):
+    # Hidden files are the manifests
+    if file_name.startswith("."):
+        return False
+    extension = os.path.splitext(file_name)[1]
+    return extension == "" or extension in COMPRESSED_EXTENSIONS
+
+
+# Removes the .gz and .br siblings of a file, returns whether there was any
+def remove_siblings(file_path):
+    removed = False
+    for extension in (".gz", ".br"):
+        if os.path.exists(file_path + extension):
+            os.remove(file_path + extension)
+            removed = True
+    return removed
+
+
+def write_atomically(file_path, content):
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+
+
+def read_chunks(file_path):
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            yield chunk
+
+
+# Writes the .gz and .br siblings of a file, by chunks, each in a temporary file that then
+# replaces the target. This runs in the worker processes.
+def compress_file(file_path):
+    is_large = os.path.getsize(file_path) >= LARGE_FILE_SIZE
+
+    tmp_path = "{}.gz.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        with gzip.GzipFile(
+            filename="",
+            mode="wb",
+            compresslevel=GZIP_LEVELS[is_large],
+            fileobj=f,
+            mtime=0,
+        ) as gzip_file:
+            for chunk in read_chunks(file_path):
+                gzip_file.write(chunk)
+    os.replace(tmp_path, file_path + ".gz")
+
+    if brotli is not None:
+        tmp_path = "{}.br.{}.tmp".format(file_path, os.getpid())
+        compressor = brotli.Compressor(quality=BROTLI_QUALITIES[is_large])
+        with open(tmp_path, "wb") as f:
+            for chunk in read_chunks(file_path):
+                f.write(compressor.process(chunk))
+            f.write(compressor.finish())
+        os.replace(tmp_path, file_path + ".br")
+    return file_path
+
+
+class Command(BaseCommand):
+    help = "Write the precompressed .gz and .br versions of the static files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", type=str)
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--force", action="store_true")
+
+    def handle(self, *args, **options):
+        root_dir = options["dir"] or settings.STATIC_ROOT
+        if not root_dir or not os.path.isdir(root_dir):
+            print(
+                "The folder {} does not exist, nothing has been done.".format(root_dir)
+            )
+            return
+        if brotli is None:
+            print("brotli is not installed, only the .gz files are written")
+
+        manifest_path = os.path.join(root_dir, MANIFEST_NAME)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        # A file is compressed again if its content changed, the size and modification time
+        # saving the digest computation for the untouched files
+        new_manifest = {}
+        to_compress = []
+        num_removed = 0
+        for root, dirs, files in os.walk(root_dir):
+            for file_name in files:
+                if not is_compressed(file_name):
+                    continue
+                file_path = os.path.join(root, file_name)
+                stat = os.stat(file_path)
+                rel_path = os.path.relpath(file_path, root_dir)
+                if stat.st_size < MIN_SIZE:
+                    # The file may have been bigger, its siblings are then outdated
+                    if remove_siblings(file_path):
+                        num_removed += 1
+                    continue
+                previous = None if options["force"] else manifest.get(rel_path)
+                siblings_exist = os.path.exists(file_path + ".gz") and (
+                    brotli is None or os.path.exists(file_path + ".br")
+                )
+                if (
+                    previous is not None
+                    and siblings_exist
+                    and previous["size"] == stat.st_size
+                    and previous["mtime"] == stat.st_mtime_ns
+                ):
+                    new_manifest[rel_path] = previous
+                    continue
+                digest = file_digest(file_path)
+                new_manifest[rel_path] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "digest": digest,
+                }
+                if (
+                    previous is None
+                    or previous["digest"] != digest
+                    or not siblings_exist
+                ):
+                    to_compress.append(file_path)
+
+        # The files that are gone or no longer compressed must not leave their siblings
+        # behind, they would be served instead of the actual file
+        for rel_path in manifest:
+            if rel_path not in new_manifest:
+                if remove_siblings(os.path.join(root_dir, rel_path)):
+                    num_removed += 1
+
+        print(
+            "{} files to compress, {} files are up to date, outdated siblings of {} files removed".format(
+                len(to_compress), len(new_manifest) - len(to_compress), num_removed
+            )
+        )
+        start_time = time.perf_counter()
+        if options["workers"] > 1 and len(to_compress) > 1:
+            with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                for _ in executor.map(compress_file, to_compress, chunksize=8):
+                    pass
+        else:
+            for file_path in to_compress:
+                compress_file(file_path)
+
+        write_atomically(manifest_path, json.dumps(new_manifest, indent=1).encode())
+        print(
+            "{} files compressed in {:.2f}s".format(
+                len(to_compress), time.perf_counter() - start_time
+            )
+        )
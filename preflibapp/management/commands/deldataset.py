@@ -1,9 +1,11 @@
 from django.core.management.base import BaseCommand
 from django.contrib.staticfiles import finders
+from django.core import management
 from django.utils import timezone
 from django.db.models import Max
 
 from preflibapp.models import *
+from preflibapp.generations import bump_generations
 
 import traceback
 import shutil
@@ -60,9 +62,11 @@ class Command(BaseCommand):
             if options["all"]:
                 options["abb"] = DataSet.objects.values_list("abbreviation", flat=True)
 
+            deleted_datasets = []
             for abbreviation in options["abb"]:
                 # Get the dataset
                 dataset = DataSet.objects.get(abbreviation=abbreviation)
+                deleted_datasets.append(dataset.series_number)
 
                 # Delete the static files
                 shutil.rmtree(os.path.join(data_dir, dataset.abbreviation))
@@ -72,6 +76,12 @@ class Command(BaseCommand):
 
                 print("Dataset {} has been deleted".format(abbreviation))
 
+            # Refreshing the bounds of the search sliders and the statistics
+            management.call_command("updatesearchbounds")
+            management.call_command("updatesitestatistics")
+            # The cached pages of the deleted datasets are outdated
+            bump_generations(deleted_datasets)
+
             # Finalizing the log
             log.append("</ul>\n<p>The datasets have been successfully deleted in ")
             log.append(str((timezone.now() - start_time).total_seconds() / 60))
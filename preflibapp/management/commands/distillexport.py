@@ -0,0 +1,255 @@
+from django.core.management.base import BaseCommand
+from django.core import management
+from django.conf import settings
+from django.db import connections
+from django_distill.renderer import DistillRenderer, render_pattern
+from django_distill.request import get_static_filepath
+from django_distill.static import filter_static_dirs
+from django_distill.urls import get_distilled_url_by_name
+
+import django
+
+from preflibapp.generations import (
+    GLOBAL_GENERATION,
+    dataset_generation_key,
+    get_generation,
+    get_templates_state,
+)
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import traceback
+
+MANIFEST_NAME = ".distill-manifest.json"
+
+
+def init_worker():
+    # Each worker process sets Django up once, and accepts any host as distill does
+    django.setup()
+    settings.ALLOWED_HOSTS = ["*"]
+
+
+# Writes the content in a temporary file that then replaces the target, so that the target
+# is never seen half written
+def write_atomically(file_path, content):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+
+
+# Renders a page and writes it in the output directory. This runs in the worker processes.
+def render_page(task):
+    result = {"uri": task["uri"], "inputs": task["inputs"]}
+    try:
+        pattern = get_distilled_url_by_name(task["name"], namespace=task["namespace"])
+        start_time = time.perf_counter()
+        uri, file_name, _status, _headers, body = render_pattern(
+            pattern, task["param_set"], None
+        )
+        result["render_time"] = time.perf_counter() - start_time
+        full_path, _ = get_static_filepath(Path(task["output_dir"]), file_name, uri)
+        write_atomically(str(full_path), body)
+        result["file"] = os.path.relpath(full_path, task["output_dir"])
+        result["digest"] = hashlib.sha256(body).hexdigest()
+    except Exception as e:
+        result["error"] = str(e) + "\n" + traceback.format_exc()
+    return result
+
+
+# Copies the files of source_dir that are missing or outdated in target_dir, and removes the
+# files of target_dir that are no longer in source_dir. The directories skipped are the ones
+# distill skips when it copies the static files. Returns the numbers of files copied and removed.
+def sync_directory(source_dir, target_dir):
+    num_copied = 0
+    source_files = set()
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = filter_static_dirs(dirs)
+        for file_name in files:
+            source_path = os.path.join(root, file_name)
+            # The precompressed siblings of the files are written by compressstatic
+            base_path, extension = os.path.splitext(source_path)
+            if extension in (".gz", ".br") and os.path.exists(base_path):
+                continue
+            rel_path = os.path.relpath(source_path, source_dir)
+            source_files.add(rel_path)
+            target_path = os.path.join(target_dir, rel_path)
+            source_stat = os.stat(source_path)
+            if os.path.exists(target_path):
+                target_stat = os.stat(target_path)
+                if (
+                    target_stat.st_size == source_stat.st_size
+                    and target_stat.st_mtime_ns == source_stat.st_mtime_ns
+                ):
+                    continue
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copy2(source_path, target_path)
+            num_copied += 1
+
+    num_removed = 0
+    for root, dirs, files in os.walk(target_dir):
+        for file_name in files:
+            rel_path = os.path.relpath(os.path.join(root, file_name), target_dir)
+            if rel_path in source_files:
+                continue
+            base_path, extension = os.path.splitext(rel_path)
+            if extension in (".gz", ".br") and base_path in source_files:
+                continue
+            os.remove(os.path.join(root, file_name))
+            num_removed += 1
+    return num_copied, num_removed
+
+
+def render_all_pages(tasks, workers):
+    if workers <= 1:
+        for task in tasks:
+            yield render_page(task)
+        return
+
+    # The workers must not inherit the database connections of this process
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = [executor.submit(render_page, task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class Command(BaseCommand):
+    help = "Export the distilled pages of the website, only rendering the outdated ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_dir", type=str)
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--force", action="store_true")
+        parser.add_argument("--top", type=int, default=10)
+        parser.add_argument("--exclude-staticfiles", action="store_true")
+
+    def handle(self, *args, **options):
+        output_dir = os.path.abspath(options["output_dir"])
+        os.makedirs(output_dir, exist_ok=True)
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        manifest = {}
+        if os.path.exists(manifest_path) and not options["force"]:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        # The inputs of a page are the templates and the generation of the data it shows
+        templates = get_templates_state()[0]
+        generations = {}
+        tasks = []
+        num_skipped = 0
+        uris = set()
+        with DistillRenderer() as renderer:
+            for pattern, param_set, uri in renderer.get_urls_to_render():
+                uris.add(uri)
+                if isinstance(param_set, dict) and "dataset_num" in param_set:
+                    key = dataset_generation_key(param_set["dataset_num"])
+                else:
+                    key = GLOBAL_GENERATION
+                if key not in generations:
+                    generations[key] = get_generation(key)
+                inputs = "{}.{}.{}".format(templates, key, generations[key])
+                previous = manifest.get(uri)
+                if (
+                    previous is not None
+                    and previous["inputs"] == inputs
+                    and os.path.exists(os.path.join(output_dir, previous["file"]))
+                ):
+                    num_skipped += 1
+                    continue
+                tasks.append(
+                    {
+                        "name": pattern.name,
+                        "namespace": pattern.distill_namespace,
+                        "param_set": param_set,
+                        "uri": uri,
+                        "inputs": inputs,
+                        "output_dir": output_dir,
+                    }
+                )
+            print(
+                "{} pages to render, {} pages are up to date".format(
+                    len(tasks), num_skipped
+                )
+            )
+
+            start_time = time.perf_counter()
+            rendered = []
+            for result in render_all_pages(tasks, options["workers"]):
+                if "error" in result:
+                    print("ERROR while rendering {}".format(result["uri"]))
+                    print(result["error"])
+                    continue
+                manifest[result["uri"]] = {
+                    "file": result["file"],
+                    "inputs": result["inputs"],
+                    "digest": result["digest"],
+                    "render_time": result["render_time"],
+                }
+                rendered.append(result)
+            total_time = time.perf_counter() - start_time
+
+        # The pages that are no longer rendered (deleted datasets for instance) are removed
+        num_removed = 0
+        for uri in [uri for uri in manifest if uri not in uris]:
+            file_path = os.path.join(output_dir, manifest.pop(uri)["file"])
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            num_removed += 1
+        if num_removed:
+            print("{} pages that are no longer rendered removed".format(num_removed))
+
+        write_atomically(manifest_path, json.dumps(manifest, indent=1).encode())
+
+        # Copying the static and media files next to the pages, as distill does
+        if not options["exclude_staticfiles"]:
+            for url, root_dir in (
+                (
+                    getattr(settings, "STATIC_URL", ""),
+                    getattr(settings, "STATIC_ROOT", ""),
+                ),
+                (
+                    getattr(settings, "MEDIA_URL", ""),
+                    getattr(settings, "MEDIA_ROOT", ""),
+                ),
+            ):
+                # The files go in the folder of their URL, never in the root of the export
+                url = str(url or "").strip("/")
+                if not url or not root_dir or not os.path.isdir(root_dir):
+                    continue
+                num_copied, num_deleted = sync_directory(
+                    str(root_dir), os.path.join(output_dir, url)
+                )
+                print(
+                    "{}: {} files copied, {} files removed".format(
+                        url, num_copied, num_deleted
+                    )
+                )
+
+        # Precompressing the pages, the unchanged ones are skipped
+        management.call_command(
+            "compressstatic", dir=output_dir, workers=options["workers"]
+        )
+
+        print(
+            "{} pages rendered in {:.2f}s with {} worker(s)".format(
+                len(rendered), total_time, options["workers"]
+            )
+        )
+        if rendered:
+            print("Slowest pages:")
+            for result in sorted(rendered, key=lambda r: -r["render_time"])[
+                : options["top"]
+            ]:
+                print(
+                    "{:>9.1f} ms  {}".format(
+                        result["render_time"] * 1000, result["uri"]
+                    )
+                )
@@ -1,55 +1,127 @@
 from django.core.management.base import BaseCommand
 from django.contrib.staticfiles import finders
 from django.core import management
-from django.db.models import Max
+from django.db import connections
+from django.db.models import Max, Prefetch
 
 from preflibapp.models import *
+from preflibapp.generations import bump_generations
+from preflibapp.scripts import file_digest
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import json
 import traceback
 import zipfile
 import os
 
 
-def zip_dataset(dataset, data_dir):
-    # First locate the dataset folder
-    ds_dir = os.path.join(data_dir, dataset.abbreviation)
-    # Create the zip file for the dataset
-    zipf = zipfile.ZipFile(
-        os.path.join(ds_dir, dataset.abbreviation + ".zip"), "w", zipfile.ZIP_DEFLATED
+# The manifest of an archive lists the names, sizes and digests of its members. It is kept
+# next to the archive in a hidden file, that collectstatic does not copy.
+def manifest_path(zip_path):
+    return os.path.join(
+        os.path.dirname(zip_path), "." + os.path.basename(zip_path) + ".manifest.json"
     )
 
-    # Add all the files to the zip archive
-    for datafile in dataset.files.all():
-        zipf.write(os.path.join(ds_dir, datafile.file_name), datafile.file_name)
 
-    # Add the info.txt file to the archive
-    zipf.write(os.path.join(ds_dir, "info.txt"), "info.txt")
+def manifest_entry(file_path, arc_name, digest=None):
+    # The digest stored in the database is used when there is one
+    if not digest:
+        digest = file_digest(file_path)
+    return [arc_name, os.path.getsize(file_path), digest]
 
-    # Closing the archive
-    zipf.close()
 
-    data_dir_name = os.path.basename(os.path.normpath(data_dir))
-    dataset.zip_file_path = os.path.join(
-        data_dir_name, dataset.abbreviation, dataset.abbreviation + ".zip"
-    )
-    dataset.zip_file_size = os.path.getsize(
-        os.path.join(ds_dir, dataset.abbreviation + ".zip")
-    )
-    dataset.save()
+# An archive is up to date if it exists and its manifest is the one it would have now
+def is_up_to_date(task):
+    if not os.path.exists(task["zip_path"]):
+        return False
+    try:
+        with open(manifest_path(task["zip_path"])) as f:
+            return json.load(f) == task["manifest"]
+    except (OSError, ValueError):
+        return False
 
 
-def zip_type(data_type, data_dir):
-    if data_type in ("dat",):
-        return
-    zipf = zipfile.ZipFile(
-        os.path.join(data_dir, "types", data_type + ".zip"), "w", zipfile.ZIP_DEFLATED
+def write_atomically(file_path, write):
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    write(tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def write_zip_file(task, tmp_path):
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for file_path, arc_name in task["members"]:
+            zipf.write(file_path, arc_name)
+
+
+def write_manifest_file(task, tmp_path):
+    with open(tmp_path, "w") as f:
+        json.dump(task["manifest"], f)
+
+
+# Writes a zip archive and then its manifest, each in a temporary file that then replaces
+# the target, so that neither is ever seen half written. This runs in the worker processes.
+def write_zip(task):
+    write_atomically(task["zip_path"], lambda path: write_zip_file(task, path))
+    write_atomically(
+        manifest_path(task["zip_path"]), lambda path: write_manifest_file(task, path)
     )
-    for datafile in DataFile.objects.filter(data_type=data_type):
-        zipf.write(
-            os.path.join(os.path.dirname(data_dir), datafile.file_path),
-            datafile.file_name,
+    return task["name"], task["zip_path"], os.path.getsize(task["zip_path"])
+
+
+def dataset_zip_task(dataset, data_dir):
+    # First locate the dataset folder
+    ds_dir = os.path.join(data_dir, dataset.abbreviation)
+    # All the files of the dataset and the info.txt file
+    members = []
+    manifest = []
+    for datafile in dataset.files.all():
+        file_path = os.path.join(ds_dir, datafile.file_name)
+        members.append((file_path, datafile.file_name))
+        manifest.append(
+            manifest_entry(file_path, datafile.file_name, datafile.content_digest)
         )
-    zipf.close()
+    members.append((os.path.join(ds_dir, "info.txt"), "info.txt"))
+    manifest.append(manifest_entry(os.path.join(ds_dir, "info.txt"), "info.txt"))
+    return {
+        "name": dataset.abbreviation,
+        "zip_path": os.path.join(ds_dir, dataset.abbreviation + ".zip"),
+        "members": members,
+        "manifest": manifest,
+    }
+
+
+def type_zip_task(data_type, data_dir):
+    members = []
+    manifest = []
+    for file_path, file_name, digest in (
+        DataFile.objects.filter(data_type=data_type)
+        .order_by("file_name")
+        .values_list("file_path", "file_name", "content_digest")
+    ):
+        file_path = os.path.join(os.path.dirname(data_dir), file_path)
+        members.append((file_path, file_name))
+        manifest.append(manifest_entry(file_path, file_name, digest))
+    return {
+        "name": data_type,
+        "zip_path": os.path.join(data_dir, "types", data_type + ".zip"),
+        "members": members,
+        "manifest": manifest,
+    }
+
+
+def write_all_zips(tasks, workers):
+    if workers <= 1:
+        for task in tasks:
+            yield write_zip(task)
+        return
+
+    # The workers do not use the database, they must not inherit its connections either
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_zip, task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
 
 
 class Command(BaseCommand):
@@ -58,6 +130,10 @@ class Command(BaseCommand):
     log = []
     new_log_num = 0
 
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--force", action="store_true")
+
     def handle(self, *args, **options):
         # Finding the data dir in the static folder
         data_dir = finders.find("data")
@@ -89,34 +165,67 @@ class Command(BaseCommand):
             ]
             start_time = timezone.now()
 
-            # We start by zipping the data sets
-            log.append("<p>Zipping data sets...</p>\n<ul>\n")
-            for ds in DataSet.objects.all():
-                print("Zipping dataset " + str(ds))
-                log.append("\t<li>Zipping dataset " + str(ds) + "... ")
-                zip_dataset(ds, data_dir)
-                log.append(" ... done.</li>\n")
-            log.append("</ul>\n<p>... done.</p>\n")
-
-            # We will now zip the files per type, starting by creating the corresponding folder
+            # The per type archives go in their own folder
             try:
                 os.makedirs(os.path.join(data_dir, "types"))
             except OSError:
                 pass
 
-            # We actually zip the types
-            log.append("\n<p>Zipping data files by type</p>\n<ul>\n")
-            for data_type in (
-                DataFile.objects.order_by()
+            # Collecting what goes in each archive, the data sets and the types are then
+            # zipped concurrently
+            datasets = list(
+                DataSet.objects.prefetch_related(
+                    Prefetch("files", queryset=DataFile.objects.order_by("file_name"))
+                )
+            )
+            dataset_tasks = [dataset_zip_task(ds, data_dir) for ds in datasets]
+            type_tasks = [
+                type_zip_task(data_type, data_dir)
+                for data_type in DataFile.objects.order_by()
                 .values_list("data_type", flat=True)
                 .distinct()
-            ):
-                print("Zipping type " + data_type)
-                log.append("\t<li>Zipping type " + data_type + "... ")
-                zip_type(data_type, data_dir)
-                log.append(" ... done.</li>\n")
+                if data_type not in ("dat",)
+            ]
+
+            # Only the archives whose members changed are written again
+            zip_sizes = {}
+            stale_tasks = []
+            for task in dataset_tasks + type_tasks:
+                if not options["force"] and is_up_to_date(task):
+                    zip_sizes[task["zip_path"]] = os.path.getsize(task["zip_path"])
+                else:
+                    stale_tasks.append(task)
+            log.append(
+                "<p>{} archives are up to date, zipping {} archives with {} worker(s)...</p>\n<ul>\n".format(
+                    len(zip_sizes), len(stale_tasks), options["workers"]
+                )
+            )
+            for name, zip_path, size in write_all_zips(stale_tasks, options["workers"]):
+                print("Zipped " + name)
+                log.append("\t<li>Zipped " + name + "</li>\n")
+                zip_sizes[zip_path] = size
             log.append("</ul>\n<p>... done.</p>\n")
 
+            # Saving the paths and sizes of the dataset archives in one go
+            data_dir_name = os.path.basename(os.path.normpath(data_dir))
+            for ds, task in zip(datasets, dataset_tasks):
+                ds.zip_file_size = zip_sizes[task["zip_path"]]
+                ds.zip_file_path = os.path.join(
+                    data_dir_name, ds.abbreviation, ds.abbreviation + ".zip"
+                )
+            DataSet.objects.bulk_update(
+                datasets, ["zip_file_path", "zip_file_size"], batch_size=500
+            )
+
+            # The sizes of the zip files are displayed on the pages of the datasets
+            if stale_tasks:
+                stale_paths = set(task["zip_path"] for task in stale_tasks)
+                bump_generations(
+                    ds.series_number
+                    for ds, task in zip(datasets, dataset_tasks)
+                    if task["zip_path"] in stale_paths
+                )
+
             # We finish the log
             log.append("\n<p>Regeneration of the zip files successfully completed in ")
             log.append(
@@ -127,6 +236,7 @@ class Command(BaseCommand):
             # And finally collect the statics
             print("Finished, collecting statics")
             management.call_command("collectstatic", no_input=False)
+            management.call_command("compressstatic")
 
         except Exception as e:
             # If anything happened, we log it and move on
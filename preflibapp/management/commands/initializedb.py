@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 
-from preflibapp.models import Metadata, DataTag
+from preflibapp.models import Metadata, DataSet, DataTag
+from preflibapp.generations import bump_generations
 
 
 def initialize_tags():
@@ -79,6 +80,8 @@ def initialize_metadata():
             "search_question": "Number of alternatives:",
             "search_res_name": "#Alternatives",
             "order_priority": 1,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -99,6 +102,8 @@ def initialize_metadata():
             "search_question": "Number of voters:",
             "search_res_name": "#Voters",
             "order_priority": 2,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -118,6 +123,8 @@ def initialize_metadata():
             "search_question": "Number of unique orders:",
             "search_res_name": "#Unique Ballots",
             "order_priority": 4,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -138,6 +145,8 @@ def initialize_metadata():
             "search_question": "Is strict?",
             "search_res_name": "Strict",
             "order_priority": 11,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -158,6 +167,8 @@ def initialize_metadata():
             "search_question": "Is complete?",
             "search_res_name": "Complete",
             "order_priority": 12,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -179,6 +190,8 @@ def initialize_metadata():
             "search_question": "Is an approval profile?",
             "search_res_name": "Approval",
             "order_priority": 13,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -199,6 +212,10 @@ def initialize_metadata():
             "search_question": "Is single-peaked?",
             "search_res_name": "Single-Peaked",
             "order_priority": 14,
+            "version": 1,
+            "cost_tier": 2,
+            "time_budget": 600,
+            "memory_budget": 4096,
         },
     )
 
@@ -219,6 +236,10 @@ def initialize_metadata():
             "search_question": "Is single-crossing?",
             "search_res_name": "Single-Crossing",
             "order_priority": 15,
+            "version": 1,
+            "cost_tier": 2,
+            "time_budget": 600,
+            "memory_budget": 4096,
         },
     )
 
@@ -241,6 +262,8 @@ def initialize_metadata():
             "search_question": "Size of the largest ballot:",
             "search_res_name": "Largest Ballot",
             "order_priority": 6,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -263,6 +286,8 @@ def initialize_metadata():
             "search_question": "Size of the smallest ballot:",
             "search_res_name": "Smallest Ballot",
             "order_priority": 5,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -285,6 +310,8 @@ def initialize_metadata():
             "search_question": "Maximum number of indifferences:",
             "search_res_name": "Max #Indif.",
             "order_priority": 8,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -307,6 +334,8 @@ def initialize_metadata():
             "search_question": "Minimum number of indifferences:",
             "search_res_name": "Min #Indif.",
             "order_priority": 7,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -329,6 +358,8 @@ def initialize_metadata():
             "search_question": "Size of the largest indifference:",
             "search_res_name": "Largest Indif.",
             "order_priority": 10,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -351,6 +382,8 @@ def initialize_metadata():
             "search_question": "Size of the smallest indifference:",
             "search_res_name": "Smallest Indif.",
             "order_priority": 9,
+            "version": 1,
+            "cost_tier": 0,
         },
     )
 
@@ -371,6 +404,10 @@ def initialize_metadata():
             "search_question": "Has a Condorcet winner?",
             "search_res_name": "Condorcet",
             "order_priority": 16,
+            "version": 1,
+            "cost_tier": 2,
+            "time_budget": 600,
+            "memory_budget": 4096,
         },
     )
 
@@ -387,3 +424,5 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         initialize_tags()
         initialize_metadata()
+        # The tags and the metadata are displayed on most pages, the dataset pages included
+        bump_generations(DataSet.objects.values_list("series_number", flat=True))
@@ -0,0 +1,126 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max, Sum
+
+from preflibapp.models import *
+
+import math
+
+PERCENTILES = (50, 90, 99)
+
+
+# Nearest-rank percentile of a sorted list of values
+def percentile(sorted_values, p):
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+# The peak of memory is None when the run was not profiled
+def format_memory(peak_memory):
+    if peak_memory is None:
+        return "not profiled"
+    return "{:.0f} KiB".format(peak_memory / 1024)
+
+
+def format_costs(wall_times, peak_memories):
+    wall_times = sorted(wall_times)
+    peak_memories = sorted(m for m in peak_memories if m is not None)
+    res = "{:>6} runs | time (ms) {} max {:.1f}".format(
+        len(wall_times),
+        " ".join(
+            "p{} {:.1f}".format(p, percentile(wall_times, p) * 1000)
+            for p in PERCENTILES
+        ),
+        wall_times[-1] * 1000,
+    )
+    if not peak_memories:
+        return res + " | memory not profiled"
+    return res + " | memory (KiB) {} max {:.0f}".format(
+        " ".join(
+            "p{} {:.0f}".format(p, percentile(peak_memories, p) / 1024)
+            for p in PERCENTILES
+        ),
+        peak_memories[-1] / 1024,
+    )
+
+
+class Command(BaseCommand):
+    help = "Report the cost of the metadata computations of a run of updatemetadata"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--log-num", type=int)
+        parser.add_argument("--top", type=int, default=10)
+
+    def handle(self, *args, **options):
+        log_num = options["log_num"]
+        if log_num is None:
+            log_num = MetadataComputation.objects.aggregate(Max("log_num"))[
+                "log_num__max"
+            ]
+            if log_num is None:
+                print("No metadata computation has been recorded yet.")
+                return
+        computations = MetadataComputation.objects.filter(log_num=log_num)
+        print("Metadata computations of the run #{}".format(log_num))
+        for status, count in (
+            computations.values_list("status").annotate(Count("pk")).order_by("status")
+        ):
+            print("{:>18}: {}".format(status, count))
+
+        # The values settled by the implications cost nothing, they are left out
+        computations = computations.exclude(status__in=("derived", "pruned"))
+
+        # Grouping the costs per metadata, None standing for the parsing of the files
+        costs = {}
+        for metadata_id, wall_time, peak_memory in computations.values_list(
+            "metadata_id", "wall_time", "peak_memory"
+        ):
+            metadata_costs = costs.setdefault(metadata_id, ([], []))
+            metadata_costs[0].append(wall_time)
+            metadata_costs[1].append(peak_memory)
+        if not costs:
+            print("Nothing has been recorded for this run.")
+            return
+        metadata_names = dict(Metadata.objects.values_list("pk", "short_name"))
+
+        print("\nSlowest metadata (total time):")
+        for metadata_id, (wall_times, peak_memories) in sorted(
+            costs.items(), key=lambda item: -sum(item[1][0])
+        ):
+            name = "(parsing)" if metadata_id is None else metadata_names[metadata_id]
+            print(
+                "{:>18} total {:>9.2f}s | {}".format(
+                    name, sum(wall_times), format_costs(wall_times, peak_memories)
+                )
+            )
+
+        print("\nSlowest data files (total time):")
+        slowest_files = (
+            computations.values("datafile__file_name")
+            .annotate(total_time=Sum("wall_time"), peak_memory=Max("peak_memory"))
+            .order_by("-total_time")[: options["top"]]
+        )
+        for datafile in slowest_files:
+            print(
+                "{:>30} total {:>9.2f}s | peak memory {}".format(
+                    datafile["datafile__file_name"],
+                    datafile["total_time"],
+                    format_memory(datafile["peak_memory"]),
+                )
+            )
+
+        print("\nSlowest single computations:")
+        for computation in computations.select_related("datafile", "metadata")[
+            : options["top"]
+        ]:
+            print(
+                "{:>30} {:>18} {:>9.3f}s | {}".format(
+                    computation.datafile.file_name,
+                    (
+                        "(parsing)"
+                        if computation.metadata is None
+                        else computation.metadata.short_name
+                    ),
+                    computation.wall_time,
+                    format_memory(computation.peak_memory),
+                )
+            )
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.core import management
+from django.contrib.staticfiles import finders
+from django.db.models import OuterRef, Q, Subquery
+
+from preflibapp.models import *
+from preflibapp.generations import bump_generations
+from preflibapp.scripts import file_digest, file_preview, file_line_index
+
+
+# Fills in the digest, the preview and the line index of the data files that do not have them
+def update_datafile_contents():
+    num_updated = 0
+    for datafile in DataFile.objects.filter(
+        Q(content_digest="") | Q(preview=[]) | Q(num_lines=0)
+    ).iterator():
+        file_path = finders.find(datafile.file_path)
+        if file_path is None:
+            print("The file {} was not found, it is skipped".format(datafile.file_path))
+            continue
+        num_lines, line_index = file_line_index(file_path)
+        DataFile.objects.filter(pk=datafile.pk).update(
+            content_digest=file_digest(file_path),
+            preview=file_preview(file_path),
+            num_lines=num_lines,
+            line_index=line_index,
+        )
+        num_updated += 1
+    return num_updated
+
+
+# Fills in the typed columns of the data properties that have none of them
+def update_typed_values():
+    dataprops = []
+    for dataprop in (
+        DataProperty.objects.filter(
+            numeric_value__isnull=True,
+            bool_value__isnull=True,
+            metadata__inner_type__in=("bool", "int", "float"),
+        )
+        .select_related("metadata")
+        .iterator()
+    ):
+        dataprop.update_typed_values()
+        dataprops.append(dataprop)
+    DataProperty.objects.bulk_update(
+        dataprops, ["numeric_value", "bool_value"], batch_size=500
+    )
+    return len(dataprops)
+
+
+# The properties computed before their source was recorded are taken as computed on the
+# current content of their file with the current version of their metadata, so that
+# updatemetadata --changed-only does not compute them again
+def update_dataprop_sources():
+    num_digests = DataProperty.objects.filter(source_digest="").update(
+        source_digest=Subquery(
+            DataFile.objects.filter(pk=OuterRef("datafile_id")).values(
+                "content_digest"
+            )[:1]
+        )
+    )
+    num_versions = DataProperty.objects.filter(metadata_version=0).update(
+        metadata_version=Subquery(
+            Metadata.objects.filter(pk=OuterRef("metadata_id")).values("version")[:1]
+        )
+    )
+    return max(num_digests, num_versions)
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild everything that is derived from the data already in the database: the "
+        "typed values and the sources of the properties, the previews of the files, the "
+        "search tables and the site statistics. Run it after upgrading an existing database."
+    )
+
+    def handle(self, *args, **options):
+        num_files = update_datafile_contents()
+        self.stdout.write("Contents of {} data files updated\n".format(num_files))
+        num_props = update_dataprop_sources()
+        self.stdout.write("Sources of {} data properties updated\n".format(num_props))
+        num_props = update_typed_values()
+        self.stdout.write(
+            "Typed values of {} data properties updated\n".format(num_props)
+        )
+        management.call_command("updatesearchfacts", all=True)
+        management.call_command("updatesearchbounds")
+        management.call_command("updatesitestatistics")
+        bump_generations(DataSet.objects.values_list("series_number", flat=True))
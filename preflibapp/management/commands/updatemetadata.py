@@ -1,42 +1,296 @@
 from django.core.management.base import BaseCommand
 from django.contrib.staticfiles import finders
 from django.core import management
-from django.db.models import Max, Count
+from django.db import connections, transaction
+from django.db.models import Max, Count, F, Q
 
 import django
 
 from preflibtools.instances.preflibinstance import get_parsed_instance
 from preflibapp.models import *
+from preflibapp import implications
+from preflibapp.scripts import file_digest, file_preview, file_line_index
+from preflibapp.generations import bump_generations
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import importlib
+import multiprocessing
+import resource
 import traceback
+import time
+import tracemalloc
 
+DEFAULT_BATCH_SIZE = 50
+OVER_BUDGET_STATUSES = ("timed_out", "out_of_memory")
 
-def update_dataprop(pk_log_meta):
+
+def init_worker():
+    # Each worker process sets Django up once
     django.setup()
-    datafile_pk, log, metadata = pk_log_meta
-    datafile = DataFile.objects.get(pk=datafile_pk)
-    log.append("\n\t<li>Data file " + str(datafile.file_name) + "... ")
-    # Finding the actual file referred by the datafile and parsing it
-    preflib_instance = get_parsed_instance(finders.find(datafile.file_path))
-    if preflib_instance is not None:
-        print("\nData file " + str(datafile.file_name) + "...")
-        for m in metadata:
-            if datafile.data_type in m.applies_to_list():
-                # If the metadata applies to the datafile we compute its value and save it
-                dataprop_obj, _ = DataProperty.objects.update_or_create(
-                    datafile=datafile,
-                    metadata=m,
-                    defaults={
-                        "value": getattr(
-                            importlib.import_module(m.inner_module), m.inner_function
-                        )(preflib_instance)
-                    },
+
+
+# Calls the function and returns its result together with the wall time and the peak of
+# memory allocated during the call. The peak of memory is only known when tracemalloc is
+# tracing (option --profile), it is None otherwise as tracing slows everything down.
+def measured(function, *args):
+    if not tracemalloc.is_tracing():
+        start_time = time.perf_counter()
+        res = function(*args)
+        return res, (time.perf_counter() - start_time, None)
+    tracemalloc.reset_peak()
+    base_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    res = function(*args)
+    wall_time = time.perf_counter() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1] - base_memory
+    return res, (wall_time, max(peak_memory, 0))
+
+
+# Returns the size of the address space of the current process, None if it is unknown
+def current_address_space():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+# Runs the function in a forked subprocess that is killed when it goes over the time budget
+# (in seconds) and that cannot allocate more than the memory budget (in MiB). Returns the
+# status of the computation, the value and the cost.
+def run_with_budget(function, preflib_instance, time_budget, memory_budget):
+    reader, writer = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        reader.close()
+        if memory_budget is not None:
+            address_space = current_address_space()
+            if address_space is not None:
+                limit = address_space + memory_budget * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        try:
+            writer.send(("done",) + measured(function, preflib_instance))
+        except MemoryError:
+            writer.send(("out_of_memory", None, None))
+        except Exception as e:
+            writer.send(("failed", str(e) + "<br>\n" + traceback.format_exc(), None))
+
+    start_time = time.perf_counter()
+    process = multiprocessing.get_context("fork").Process(target=target)
+    process.start()
+    writer.close()
+    try:
+        if reader.poll(time_budget):
+            status, value, cost = reader.recv()
+        else:
+            status, value, cost = "timed_out", None, None
+    except EOFError:
+        # The subprocess died without answering, typically killed by the system
+        status, value, cost = "failed", "The computation was killed", None
+    finally:
+        reader.close()
+        process.kill()
+        process.join()
+    if status == "failed":
+        raise RuntimeError(value)
+    if cost is None:
+        cost = (time.perf_counter() - start_time, None)
+    return status, value, cost
+
+
+# Computes the values of the metadata for a data file. This runs in the worker processes,
+# so it only gets plain data and never touches the database. The metadata specs come in
+# dependency order so that the implications can settle values without calling the
+# preflibtools functions, the file being parsed only if some function is actually called.
+# The cost of each computation is recorded in "costs", the parsing of the file being under
+# the None key, and the computations that are not simply done in "statuses".
+def compute_dataprops(task):
+    result = {
+        "datafile_pk": task["datafile_pk"],
+        "file_name": task["file_name"],
+        "digest": task["digest"],
+        "metadata_pks": [spec["pk"] for spec in task["metadata_specs"]],
+        "values": {},
+        "costs": {},
+        "statuses": {},
+    }
+    known_values = dict(task["known_values"])
+    preflib_instance = None
+    if task["profile"]:
+        tracemalloc.start()
+    try:
+        for spec in task["metadata_specs"]:
+            if task["data_type"] not in spec["applies_to"]:
+                continue
+            if implications.is_pruned(spec["short_name"], known_values):
+                # A pruned metadata is settled to False, which replaces any previous value
+                result["costs"][spec["pk"]] = (0, None)
+                result["statuses"][spec["pk"]] = "pruned"
+                result["values"][spec["pk"]] = False
+                known_values[spec["short_name"]] = False
+                continue
+            value = implications.derive_value(spec["short_name"], known_values)
+            if value is not None:
+                result["costs"][spec["pk"]] = (0, None)
+                result["statuses"][spec["pk"]] = "derived"
+            else:
+                if preflib_instance is None:
+                    # Parsing the actual file referred by the datafile
+                    preflib_instance, result["costs"][None] = measured(
+                        get_parsed_instance, task["file_path"]
+                    )
+                    if preflib_instance is None:
+                        break
+                # If the metadata applies to the datafile we compute its value
+                function = getattr(
+                    importlib.import_module(spec["inner_module"]),
+                    spec["inner_function"],
+                )
+                if task["use_budgets"] and (
+                    spec["time_budget"] is not None or spec["memory_budget"] is not None
+                ):
+                    status, value, cost = run_with_budget(
+                        function,
+                        preflib_instance,
+                        spec["time_budget"],
+                        spec["memory_budget"],
+                    )
+                else:
+                    status = "done"
+                    value, cost = measured(function, preflib_instance)
+                result["costs"][spec["pk"]] = cost
+                if status != "done":
+                    result["statuses"][spec["pk"]] = status
+                    continue
+            result["values"][spec["pk"]] = value
+            known_values[spec["short_name"]] = value
+    except Exception as e:
+        result["error"] = str(e) + "<br>\n" + traceback.format_exc()
+    finally:
+        if task["profile"]:
+            tracemalloc.stop()
+    return result
+
+
+# Saves the values computed for a batch of data files as a single upsert, together with
+# the costs of the computations, returns the number of data properties written. When no
+# value could be computed (over budget or error), the previous value is deleted unless it
+# was computed on the current content of the file with the current version of the metadata.
+def save_dataprops(results, metadata_per_pk, log_num):
+    dataprops = []
+    computations = []
+    stale_dataprops = Q()
+    for result in results:
+        # The metadata left without a value are the ones over budget and, when the file
+        # failed, the ones of the task that were not reached
+        missing_pks = set(
+            metadata_pk
+            for metadata_pk, status in result.get("statuses", {}).items()
+            if status in OVER_BUDGET_STATUSES
+        )
+        if "error" in result:
+            missing_pks.update(
+                metadata_pk
+                for metadata_pk in result["metadata_pks"]
+                if metadata_pk not in result["values"]
+            )
+        for metadata_pk in missing_pks:
+            stale_dataprops |= Q(
+                datafile_id=result["datafile_pk"], metadata_id=metadata_pk
+            ) & ~Q(
+                source_digest=result["digest"],
+                metadata_version=metadata_per_pk[metadata_pk].version,
+            )
+        for metadata_pk, (wall_time, peak_memory) in result.get("costs", {}).items():
+            computations.append(
+                MetadataComputation(
+                    datafile_id=result["datafile_pk"],
+                    metadata_id=metadata_pk,
+                    log_num=log_num,
+                    wall_time=wall_time,
+                    peak_memory=peak_memory,
+                    status=result.get("statuses", {}).get(metadata_pk, "done"),
+                )
+            )
+        for metadata_pk, value in result["values"].items():
+            dataprop = DataProperty(
+                datafile_id=result["datafile_pk"],
+                metadata=metadata_per_pk[metadata_pk],
+                value=value,
+                source_digest=result["digest"],
+                metadata_version=metadata_per_pk[metadata_pk].version,
+            )
+            # bulk_create does not go through save(), so the typed values are set here
+            dataprop.update_typed_values()
+            dataprops.append(dataprop)
+    with transaction.atomic():
+        MetadataComputation.objects.bulk_create(computations)
+        if stale_dataprops:
+            DataProperty.objects.filter(stale_dataprops).delete()
+        if dataprops:
+            DataProperty.objects.bulk_create(
+                dataprops,
+                update_conflicts=True,
+                unique_fields=["datafile", "metadata"],
+                update_fields=[
+                    "value",
+                    "numeric_value",
+                    "bool_value",
+                    "source_digest",
+                    "metadata_version",
+                ],
+            )
+    return len(dataprops)
+
+
+# Yields the results of the computations of the tasks, possibly using a pool of workers
+def compute_all_dataprops(tasks, workers):
+    if workers <= 1:
+        for task in tasks:
+            yield compute_dataprops(task)
+        return
+
+    # The workers must not inherit the database connections of this process
+    connections.close_all()
+    print("Starting the pool of {} workers".format(workers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(compute_dataprops, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # Typically a worker that died, we only lose the file it was working on
+                task = futures[future]
+                yield {
+                    "datafile_pk": task["datafile_pk"],
+                    "file_name": task["file_name"],
+                    "digest": task["digest"],
+                    "metadata_pks": [spec["pk"] for spec in task["metadata_specs"]],
+                    "values": {},
+                    "error": str(e) + "<br>\n" + traceback.format_exc(),
+                }
+    print("Done with the pool")
+
+
+def log_dataprops(result, log, metadata_names):
+    log.append("\n\t<li>Data file " + str(result["file_name"]) + "... ")
+    if "error" in result:
+        log.append(
+            "</li>\n</ul>\n<p><strong>" + result["error"] + "</strong></p>\n<ul>"
+        )
+    elif any(s in OVER_BUDGET_STATUSES for s in result["statuses"].values()):
+        log.append(
+            " ... done, over budget for {}.</li>\n".format(
+                ", ".join(
+                    "{} ({})".format(metadata_names[pk], status)
+                    for pk, status in result["statuses"].items()
+                    if status in OVER_BUDGET_STATUSES
                 )
-                dataprop_obj.save()
-    log.append(" ... done.</li>\n")
+            )
+        )
+    else:
+        log.append(" ... done.</li>\n")
 
 
 class Command(BaseCommand):
@@ -46,6 +300,12 @@ class Command(BaseCommand):
         parser.add_argument("--abb", nargs="*", type=str)
         parser.add_argument("--all", action="store_true")
         parser.add_argument("--meta", nargs="*", type=str)
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--changed-only", action="store_true")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument("--tiers", nargs="*", type=int)
+        parser.add_argument("--ignore-budgets", action="store_true")
+        parser.add_argument("--profile", action="store_true")
 
     def handle(self, *args, **options):
         if not options["all"] and not options["abb"]:
@@ -97,19 +357,176 @@ class Command(BaseCommand):
                 + str(timezone.now())
                 + "</h4>\n<p><ul>"
             ]
-            multiproc = False
             start_time = timezone.now()
-            if multiproc:
-                print("Starting the pool")
-                pks_log_meta = [(df.pk, log, metadata) for df in datafiles]
-                with ProcessPoolExecutor(initializer=django.setup) as executor:
-                    futures = {executor.map(update_dataprop, pks_log_meta)}
-                for f in futures:
-                    pass
-                print("Done with the pool")
-            else:
+            metadata_per_pk = {m.pk: m for m in metadata}
+            metadata_names = {m.pk: m.short_name for m in metadata}
+
+            # The (file, metadata) pairs already computed on the current content of the file
+            # with the current version of the metadata function are up to date
+            up_to_date_props = set()
+            if options["changed_only"]:
+                up_to_date_props = set(
+                    DataProperty.objects.filter(
+                        datafile__in=datafiles,
+                        source_digest=F("datafile__content_digest"),
+                        metadata_version=F("metadata__version"),
+                    ).values_list("datafile_id", "metadata_id")
+                )
+
+            # Checking the content of the files
+            datafiles = list(datafiles)
+            file_paths = {}
+            for datafile in datafiles:
+                file_paths[datafile.pk] = finders.find(datafile.file_path)
+                digest = file_digest(file_paths[datafile.pk])
+                if digest != datafile.content_digest or not datafile.preview:
+                    num_lines, line_index = file_line_index(file_paths[datafile.pk])
+                    DataFile.objects.filter(pk=datafile.pk).update(
+                        content_digest=digest,
+                        preview=file_preview(file_paths[datafile.pk]),
+                        num_lines=num_lines,
+                        line_index=line_index,
+                    )
+                    datafile.content_digest = digest
+                    up_to_date_props.difference_update(
+                        (datafile.pk, m.pk) for m in metadata
+                    )
+
+            # The metadata are computed tier by tier, the values of a tier being published
+            # before moving to the next one
+            tiers = sorted(set(m.cost_tier for m in metadata))
+            if options["tiers"]:
+                tiers = [t for t in tiers if t in options["tiers"]]
+            num_rows = 0
+            save_time = 0
+            statuses_count = {}
+            for tier in tiers:
+                print("Cost tier {}".format(tier))
+                log.append("\n\t<li><strong>Cost tier {}</strong></li>\n".format(tier))
+                tier_metadata = {
+                    m.short_name: m for m in metadata if m.cost_tier == tier
+                }
+                metadata_specs = [
+                    {
+                        "pk": m.pk,
+                        "short_name": m.short_name,
+                        "inner_module": m.inner_module,
+                        "inner_function": m.inner_function,
+                        "applies_to": m.applies_to_list(),
+                        "time_budget": m.time_budget,
+                        "memory_budget": m.memory_budget,
+                    }
+                    for m in (
+                        tier_metadata[short_name]
+                        for short_name in implications.dependency_order(tier_metadata)
+                    )
+                ]
+
+                # The values the implications may use, as far as they are up to date
+                known_values = {}
+                for dataprop in DataProperty.objects.filter(
+                    datafile__in=datafiles,
+                    metadata__short_name__in=implications.used_short_names(),
+                    source_digest=F("datafile__content_digest"),
+                    metadata_version=F("metadata__version"),
+                ).select_related("metadata"):
+                    known_values.setdefault(dataprop.datafile_id, {})[
+                        dataprop.metadata.short_name
+                    ] = dataprop.typed_value()
+
+                tasks = []
+                num_skipped_files = 0
                 for datafile in datafiles:
-                    update_dataprop((datafile.pk, log, metadata))
+                    task_metadata_specs = [
+                        spec
+                        for spec in metadata_specs
+                        if datafile.data_type in spec["applies_to"]
+                        and (datafile.pk, spec["pk"]) not in up_to_date_props
+                    ]
+                    if not task_metadata_specs:
+                        num_skipped_files += 1
+                        continue
+                    tasks.append(
+                        {
+                            "datafile_pk": datafile.pk,
+                            "file_name": datafile.file_name,
+                            "file_path": file_paths[datafile.pk],
+                            "data_type": datafile.data_type,
+                            "digest": datafile.content_digest,
+                            "metadata_specs": task_metadata_specs,
+                            "use_budgets": not options["ignore_budgets"],
+                            "profile": options["profile"],
+                            "known_values": known_values.get(datafile.pk, {}),
+                        }
+                    )
+                if options["changed_only"]:
+                    print("{} data files are up to date".format(num_skipped_files))
+                    log.append(
+                        "\n\t<li>{} data files are up to date.</li>\n".format(
+                            num_skipped_files
+                        )
+                    )
+
+                # The results come back here and are saved by batches of data files
+                results = []
+                for result in compute_all_dataprops(tasks, options["workers"]):
+                    if "error" in result:
+                        print("Data file " + str(result["file_name"]) + "... failed")
+                        print(result["error"])
+                    else:
+                        print("Data file " + str(result["file_name"]) + "... done")
+                    log_dataprops(result, log, metadata_names)
+                    for status in result.get("statuses", {}).values():
+                        statuses_count[status] = statuses_count.get(status, 0) + 1
+                    results.append(result)
+                    if len(results) >= options["batch_size"]:
+                        save_start = time.perf_counter()
+                        num_rows += save_dataprops(
+                            results, metadata_per_pk, new_log_num
+                        )
+                        save_time += time.perf_counter() - save_start
+                        results = []
+                save_start = time.perf_counter()
+                num_rows += save_dataprops(results, metadata_per_pk, new_log_num)
+                save_time += time.perf_counter() - save_start
+
+                # Refreshing the search tables and the cached pages so that the tier is
+                # published
+                management.call_command("updatesearchfacts", abb=list(options["abb"]))
+                management.call_command("updatesearchbounds")
+                bump_generations(
+                    DataSet.objects.filter(abbreviation__in=options["abb"]).values_list(
+                        "series_number", flat=True
+                    )
+                )
+
+            # Reporting the computations saved thanks to the implications
+            print(
+                "{} values derived and {} computations pruned by the implications".format(
+                    statuses_count.get("derived", 0), statuses_count.get("pruned", 0)
+                )
+            )
+            log.append(
+                "\n\t<li>{} values derived and {} computations pruned by the "
+                "implications.</li>\n".format(
+                    statuses_count.get("derived", 0), statuses_count.get("pruned", 0)
+                )
+            )
+
+            rows_per_sec = num_rows / save_time if save_time > 0 else 0
+            print(
+                "{} data properties saved in {:.2f}s ({:.0f} rows/sec)".format(
+                    num_rows, save_time, rows_per_sec
+                )
+            )
+            log.append(
+                "\n\t<li>{} data properties saved in {:.2f}s ({:.0f} rows/sec).</li>\n".format(
+                    num_rows, save_time, rows_per_sec
+                )
+            )
+
+            # Refreshing the statistics of the home page
+            management.call_command("updatesitestatistics")
 
             # Closing the log
             log.append("\n<p>Metadata updated in ")
@@ -121,6 +538,7 @@ class Command(BaseCommand):
             # Collecting statics at the end
             print("Finished, collecting statics")
             management.call_command("collectstatic", no_input=False)
+            management.call_command("compressstatic")
 
         except Exception as e:
             # If an exception occured during runtime, we log it and continue
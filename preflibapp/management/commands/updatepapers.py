@@ -4,6 +4,7 @@ from django.utils import timezone
 from django.db.models import Max
 
 from preflibapp.models import *
+from preflibapp.generations import bump_generations
 
 import traceback
 import re
@@ -106,6 +107,8 @@ class Command(BaseCommand):
             print(e)
             print(traceback.format_exc())
         finally:
+            # The papers are listed on the home page, in any cases they have changed
+            bump_generations()
             # In any cases we add the log to the database
             Log.objects.create(
                 log="".join(log),
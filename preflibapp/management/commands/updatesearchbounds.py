@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from preflibapp.models import *
+
+from math import floor, ceil
+
+
+def update_search_bounds():
+    # One grouped query gives the extreme values of every range metadata
+    all_bounds = (
+        DataProperty.objects.filter(
+            metadata__search_widget="range", numeric_value__isnull=False
+        )
+        .order_by()
+        .values("metadata")
+        .annotate(min_value=Min("numeric_value"), max_value=Max("numeric_value"))
+    )
+    updated_metadata = []
+    for bounds in all_bounds:
+        max_value = ceil(bounds["max_value"])
+        min_value = floor(bounds["min_value"])
+        intermediate_value = (
+            floor((max_value - min_value) * 0.3)
+            if max_value > 30
+            else floor((max_value - min_value) * 0.5)
+        )
+        MetadataSearchBounds.objects.update_or_create(
+            metadata_id=bounds["metadata"],
+            defaults={
+                "min_value": min_value,
+                "intermediate_value": intermediate_value,
+                "max_value": max_value,
+                # If the min and max are equal, filtering on that metadata is useless
+                "is_constant": max_value == min_value,
+            },
+        )
+        updated_metadata.append(bounds["metadata"])
+    # Metadata without any value cannot be searched on
+    MetadataSearchBounds.objects.exclude(metadata__in=updated_metadata).delete()
+
+
+class Command(BaseCommand):
+    help = "Recompute the bounds of the sliders of the data search page"
+
+    def handle(self, *args, **options):
+        update_search_bounds()
+        self.stdout.write("Search bounds updated\n")
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from preflibapp.models import *
+from preflibapp.generations import bump_generations
+
+
+def update_search_facts(datafiles):
+    metadata_per_pk = {m.pk: m for m in Metadata.objects.filter(is_active=True)}
+
+    # Collecting the typed values of the properties of the data files
+    values = {}
+    properties = DataProperty.objects.filter(
+        datafile__in=datafiles, metadata__in=metadata_per_pk.keys()
+    ).order_by()
+    for prop in properties.iterator():
+        prop.metadata = metadata_per_pk[prop.metadata_id]
+        values.setdefault(prop.datafile_id, {})[
+            prop.metadata.short_name
+        ] = prop.typed_value()
+
+    facts = [
+        DataFileFacts(
+            datafile=datafile,
+            dataset_id=datafile.dataset_id,
+            data_type=datafile.data_type,
+            modification_type=datafile.modification_type,
+            values=values.get(datafile.pk, {}),
+        )
+        for datafile in datafiles.iterator()
+    ]
+
+    # Replacing the previous facts in one go so that the search never sees half of them
+    with transaction.atomic():
+        DataFileFacts.objects.filter(datafile__in=datafiles).delete()
+        DataFileFacts.objects.bulk_create(facts, batch_size=500)
+    # The search results changed
+    bump_generations()
+    return len(facts)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search table holding the metadata values of the data files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--abb", nargs="*", type=str)
+        parser.add_argument("--all", action="store_true")
+
+    def handle(self, *args, **options):
+        if not options["all"] and not options["abb"]:
+            print(
+                "ERROR: you need to pass at least one dataset (with option --abb DATASET_ABBREVIATION) or "
+                "the option --all."
+            )
+            return
+
+        datafiles = DataFile.objects.all()
+        if not options["all"]:
+            datafiles = datafiles.filter(dataset__abbreviation__in=options["abb"])
+
+        num_facts = update_search_facts(datafiles)
+        self.stdout.write("Search facts updated for {} data files\n".format(num_facts))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from preflibapp.models import *
+
+
+def update_site_statistics():
+    files_per_type = dict(
+        DataFile.objects.order_by()
+        .values_list("data_type")
+        .annotate(Count("pk"))
+        .order_by("data_type")
+    )
+    SiteStatistics.objects.update_or_create(
+        pk=1,
+        defaults={
+            "num_datasets": DataSet.objects.count(),
+            "num_datafiles": sum(files_per_type.values()),
+            "total_size": DataFile.objects.aggregate(Sum("file_size"))["file_size__sum"]
+            or 0,
+            "num_datatypes": len(files_per_type),
+            "files_per_type": files_per_type,
+        },
+    )
+
+
+class Command(BaseCommand):
+    help = "Recompute the statistics of the data displayed on the home page"
+
+    def handle(self, *args, **options):
+        update_site_statistics()
+        self.stdout.write("Site statistics updated\n")
@@ -6,7 +6,6 @@ from pydoc import locate
 
 from .choices import *
 
-
 # ================================
 #    Models related to the data
 # ================================
@@ -75,6 +74,13 @@ class Metadata(models.Model):
     search_question = models.TextField()
     search_res_name = models.CharField(max_length=100)
     order_priority = models.IntegerField()
+    # To be increased when the inner function changes, so that its values get recomputed
+    version = models.IntegerField(default=1)
+    # Metadata are computed tier by tier, cheapest first. A computation with a budget runs in a
+    # subprocess that is killed when it goes over the time (in seconds) or memory (in MiB) budget
+    cost_tier = models.IntegerField(choices=COSTTIERS, default=0)
+    time_budget = models.FloatField(blank=True, null=True)
+    memory_budget = models.IntegerField(blank=True, null=True)
 
     class Meta:
         ordering = ["order_priority", "name"]
@@ -98,6 +104,12 @@ class DataFile(models.Model):
     description = models.TextField(blank=True)
     file_path = models.CharField(max_length=255, blank=True, unique=True)
     file_size = models.FloatField(default=0)
+    content_digest = models.CharField(max_length=64, blank=True)
+    # First lines of the file, as a list of (line number, line) pairs, shown on the dataset page
+    preview = models.JSONField(default=list, blank=True)
+    # Number of lines and byte offsets of some of the lines, see scripts.file_line_index
+    num_lines = models.IntegerField(default=0)
+    line_index = models.BinaryField(default=b"", blank=True)
     relates_to = models.ForeignKey(
         "DataFile", on_delete=models.CASCADE, related_name="related_files", null=True
     )
@@ -122,20 +134,145 @@ class DataProperty(models.Model):
     datafile = models.ForeignKey(DataFile, on_delete=models.CASCADE)
     metadata = models.ForeignKey(Metadata, on_delete=models.CASCADE)
     value = models.CharField(max_length=100)
+    # Typed copies of the value, used for the indexed filters of the search and its bounds
+    numeric_value = models.FloatField(blank=True, null=True)
+    bool_value = models.BooleanField(blank=True, null=True)
+    # Digest of the file content and version of the metadata the value has been computed from
+    source_digest = models.CharField(max_length=64, blank=True)
+    metadata_version = models.IntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        self.update_typed_values()
+        return super(DataProperty, self).save(*args, **kwargs)
+
+    def update_typed_values(self):
+        self.numeric_value = None
+        self.bool_value = None
+        if self.metadata.inner_type == "bool":
+            self.bool_value = str(self.value) == "True"
+        elif self.metadata.inner_type in ("int", "float"):
+            try:
+                self.numeric_value = float(self.value)
+            except ValueError:
+                pass
 
     def typed_value(self):
         if self.metadata.inner_type == "bool":
-            return self.value == "True"
+            if self.bool_value is None:
+                return self.value == "True"
+            return self.bool_value
+        if self.numeric_value is not None:
+            return locate(self.metadata.inner_type)(self.numeric_value)
         return locate(self.metadata.inner_type)(self.value)
 
     class Meta:
         unique_together = ("datafile", "metadata")
         ordering = ("datafile", "metadata")
+        indexes = [
+            models.Index(fields=["metadata", "numeric_value"]),
+            models.Index(fields=["metadata", "bool_value"]),
+        ]
 
     def __str__(self):
         return self.datafile.__str__() + " - " + self.metadata.name
 
 
+# Denormalized copy of a data file and of its metadata values, used by the search. The data
+# types and modification types are filtered on here, the metadata values on the indexed typed
+# values of the properties; the values stored here are only read for the facets and the API.
+class DataFileFacts(models.Model):
+    datafile = models.OneToOneField(
+        DataFile, on_delete=models.CASCADE, primary_key=True, related_name="facts"
+    )
+    dataset = models.ForeignKey(DataSet, on_delete=models.CASCADE, related_name="+")
+    data_type = models.CharField(choices=DATATYPES, max_length=5)
+    modification_type = models.CharField(choices=MODIFICATIONTYPES, max_length=20)
+    # Typed value of each active metadata, keyed by the short name of the metadata
+    values = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["datafile"]
+        indexes = [models.Index(fields=["data_type", "modification_type"])]
+
+    def __str__(self):
+        return self.datafile.__str__() + " - facts"
+
+
+class MetadataSearchBounds(models.Model):
+    metadata = models.OneToOneField(
+        Metadata, on_delete=models.CASCADE, related_name="search_bounds"
+    )
+    min_value = models.IntegerField()
+    intermediate_value = models.IntegerField()
+    max_value = models.IntegerField()
+    is_constant = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ["metadata"]
+
+    def __str__(self):
+        return self.metadata.name + " - bounds"
+
+
+# Cost of a metadata computation on a data file during a run of updatemetadata, the
+# parsing of the file is recorded with an empty metadata
+class MetadataComputation(models.Model):
+    datafile = models.ForeignKey(
+        DataFile, on_delete=models.CASCADE, related_name="computations"
+    )
+    metadata = models.ForeignKey(
+        Metadata, on_delete=models.CASCADE, related_name="computations", null=True
+    )
+    # Number of the metadata log of the run
+    log_num = models.IntegerField()
+    wall_time = models.FloatField()
+    # Only measured when updatemetadata runs with --profile
+    peak_memory = models.BigIntegerField(blank=True, null=True)
+    status = models.CharField(
+        choices=COMPUTATIONSTATUSES, max_length=20, default="done"
+    )
+    computed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-log_num", "-wall_time"]
+        indexes = [models.Index(fields=["log_num", "metadata"])]
+
+    def __str__(self):
+        if self.metadata is None:
+            return self.datafile.__str__() + " - parsing"
+        return self.datafile.__str__() + " - " + self.metadata.name
+
+
+# Generation numbers of the data, increased by the commands modifying the data. They are part
+# of the cache keys of the pages, see generations.py
+class DataGeneration(models.Model):
+    key = models.CharField(max_length=50, unique=True)
+    value = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.key + " - " + str(self.value)
+
+
+# Single row snapshot of the statistics of the data, maintained by the commands that
+# modify the data
+class SiteStatistics(models.Model):
+    num_datasets = models.IntegerField(default=0)
+    num_datafiles = models.IntegerField(default=0)
+    total_size = models.FloatField(default=0)
+    num_datatypes = models.IntegerField(default=0)
+    # Number of data files of each data type
+    files_per_type = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "site statistics"
+
+    def __str__(self):
+        return "Site statistics - " + str(self.updated_at)
+
+
 # ===================================
 #    Papers that are using PrefLib
 # ===================================
@@ -2,9 +2,93 @@ from django.core import management
 
 from threading import Thread
 
+import array
+import hashlib
+
+# One line out of LINE_INDEX_STEP has its byte offset stored in the line index of a file
+LINE_INDEX_STEP = 1000
+
 
 def threaded_management_command(command, kwargs=None):
     if kwargs is None:
         kwargs = {}
     thread = Thread(target=management.call_command, args=[command], kwargs=kwargs)
     thread.start()
+
+
+# Returns the SHA-256 digest of the content of a file, reading it by chunks
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Returns the preview of a data file: its first 15 header lines and its first 10 preference
+# lines, together with their line numbers. The file is read line by line and only as far as
+# needed.
+def file_preview(file_path, max_meta_lines=15, max_pref_lines=10):
+    meta_lines = []
+    pref_lines = []
+    meta_index = 1
+    pref_index = 1
+    with open(file_path, "r", encoding="utf-8") as f:
+        for global_index, line in enumerate(f, start=1):
+            if line.startswith("#"):
+                if meta_index is not None:
+                    if meta_index <= max_meta_lines:
+                        meta_lines.append((global_index, line.strip()))
+                        meta_index += 1
+                    else:
+                        meta_lines.append(("...", "..."))
+                        meta_index = None
+            else:
+                if pref_index <= max_pref_lines:
+                    pref_lines.append((global_index, line.strip().replace(",", ", ")))
+                    pref_index += 1
+                else:
+                    pref_lines.append(("...", "..."))
+                    break
+    return meta_lines + pref_lines
+
+
+# Returns the number of lines of a file and its line index. The index is an array of unsigned
+# 64-bit integers packed as bytes: the step of the index followed by the byte offsets of the
+# lines 1, step + 1, 2 * step + 1...
+def file_line_index(file_path, step=LINE_INDEX_STEP):
+    offsets = array.array("Q", [step])
+    num_lines = 0
+    offset = 0
+    with open(file_path, "rb") as f:
+        for line in f:
+            if num_lines % step == 0:
+                offsets.append(offset)
+            num_lines += 1
+            offset += len(line)
+    return num_lines, offsets.tobytes()
+
+
+# Returns the lines start to start + count - 1 (numbered from 1) of a file, together with
+# their line numbers. The line index is used to seek close to the first line, so that only
+# the window is read.
+def read_line_window(file_path, line_index, start, count):
+    offsets = array.array("Q")
+    offsets.frombytes(bytes(line_index))
+    line_number = 1
+    with open(file_path, "rb") as f:
+        if len(offsets) > 1:
+            step = offsets[0]
+            block = min((start - 1) // step, len(offsets) - 2)
+            f.seek(offsets[block + 1])
+            line_number = block * step + 1
+        lines = []
+        for line in f:
+            if line_number >= start + count:
+                break
+            if line_number >= start:
+                lines.append(
+                    (line_number, line.decode("utf-8", errors="replace").rstrip("\r\n"))
+                )
+            line_number += 1
+    return lines
@@ -0,0 +1,296 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, Prefetch
+
+from .columnstore import get_column_store, get_data_stamp
+from .models import *
+
+import numpy as np
+
+from urllib.parse import urlencode
+from math import floor, ceil
+
+import hashlib
+import json
+
+FACETS_CACHE_TIME = 60 * 60 * 24
+FACETS_HISTOGRAM_BINS = 12
+
+
+# Returns the data types, modification types and metadata that can be searched on, together
+# with the values of the sliders of the range metadata
+def get_search_widgets():
+    types = [t for t in DATATYPES if t[0] not in ("dat", "csv")]
+    modification_types = MODIFICATIONTYPES
+    metadatas = (
+        Metadata.objects.filter(is_active=True, is_displayed=True)
+        .select_related("search_bounds")
+        .prefetch_related("upper_bounds")
+    )
+
+    # The bounds of the sliders are precomputed by the updatesearchbounds command
+    metadata_slider_values = {}
+    searchable_metadatas = []
+    for m in metadatas:
+        if m.search_widget == "range":
+            try:
+                bounds = m.search_bounds
+            except MetadataSearchBounds.DoesNotExist:
+                continue
+            metadata_slider_values[m] = (
+                bounds.min_value,
+                bounds.intermediate_value,
+                bounds.max_value,
+            )
+            # If the min and max are equal, filtering on that metadata is useless so we remove it
+            if bounds.is_constant:
+                continue
+        searchable_metadatas.append(m)
+    return types, modification_types, searchable_metadatas, metadata_slider_values
+
+
+# Reads a value of a slider from the query string, rounding it to a whole value
+def read_slider_value(value, default, rounding):
+    try:
+        return rounding(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return default
+
+
+# Returns the canonical form of the search parameters: only the answers that filter
+# something, with the ranges made whole and clamped to the bounds of the sliders, sorted by key
+def canonical_search_params(data, types, modification_types, metadatas, slider_values):
+    params = {}
+    selector_names = [t[0] for t in types] + [mt[0] for mt in modification_types]
+    selector_names += [m.short_name for m in metadatas if m.search_widget == "ternary"]
+    for name in selector_names:
+        if data.get(name + "selector") in ("yes", "no"):
+            params[name + "selector"] = data.get(name + "selector")
+
+    for m in metadatas:
+        if m.search_widget == "range" and m in slider_values:
+            min_bound, _, max_bound = slider_values[m]
+            min_value = read_slider_value(
+                data.get(m.short_name + "_slider_value_min"), min_bound, ceil
+            )
+            max_value = read_slider_value(
+                data.get(m.short_name + "_slider_value_max"), max_bound, floor
+            )
+            # A range covering the whole slider does not filter anything
+            if min_value <= min_bound and max_value >= max_bound:
+                continue
+            # A range overlapping the slider is clamped to it, which selects the same files.
+            # A range outside of the slider, or inverted, is kept as it is: no value is in it.
+            if (
+                min_bound <= max_value
+                and min_value <= max_bound
+                and min_value <= max_value
+            ):
+                min_value = max(min_value, min_bound)
+                max_value = min(max_value, max_bound)
+            params[m.short_name + "_slider_value_min"] = str(min_value)
+            params[m.short_name + "_slider_value_max"] = str(max_value)
+
+    return dict(sorted(params.items()))
+
+
+# Returns the canonical query string of a search, the page number always coming last
+def canonical_search_query(params, page=1):
+    query = list(params.items())
+    if page > 1:
+        query.append(("page", page))
+    return urlencode(query)
+
+
+# Returns the filters described by the canonical search parameters, as a dictionary
+def parse_search_filters(params, types, modification_types, metadatas):
+    datatype_filter = [t[0] for t in types]
+    for t in types:
+        if params.get(t[0] + "selector") == "no":
+            if t[0] in datatype_filter:
+                datatype_filter.remove(t[0])
+        elif params.get(t[0] + "selector") == "yes":
+            datatype_filter = [x for x in datatype_filter if x == t[0]]
+
+    # Without any answer on the modification types, they are not filtered at all
+    modiftype_filter = None
+    for mt in modification_types:
+        if params.get(mt[0] + "selector") == "no":
+            if modiftype_filter is None:
+                modiftype_filter = [x[0] for x in modification_types]
+            if mt[0] in modiftype_filter:
+                modiftype_filter.remove(mt[0])
+        elif params.get(mt[0] + "selector") == "yes":
+            if modiftype_filter is None:
+                modiftype_filter = [x[0] for x in modification_types]
+            modiftype_filter = [x for x in modiftype_filter if x == mt[0]]
+
+    # For ternary metadata, True means the property has to hold, False that it must not
+    ternary_filter = {}
+    range_filter = {}
+    for m in metadatas:
+        if m.search_widget == "ternary":
+            if params.get(m.short_name + "selector") == "no":
+                ternary_filter[m.short_name] = False
+            elif params.get(m.short_name + "selector") == "yes":
+                ternary_filter[m.short_name] = True
+        elif m.search_widget == "range":
+            if m.short_name + "_slider_value_min" in params:
+                range_filter[m.short_name] = (
+                    float(params[m.short_name + "_slider_value_min"]),
+                    float(params[m.short_name + "_slider_value_max"]),
+                )
+
+    return {
+        "data_types": datatype_filter,
+        "modification_types": modiftype_filter,
+        "ternary": ternary_filter,
+        "range": range_filter,
+    }
+
+
+# Returns the primary keys of the data files having a property of the metadata matching the
+# condition, which is read from the (metadata, typed value) indexes of the properties
+def datafiles_with_property(short_name, condition):
+    return DataProperty.objects.filter(
+        condition, metadata__short_name=short_name
+    ).values("datafile_id")
+
+
+# Compiles the filters into a single condition on the data files. The data type and the
+# modification type are read from the index of the search facts, the metadata values from the
+# indexes of the properties.
+def filter_datafiles(filters):
+    condition = Q(facts__data_type__in=filters["data_types"])
+    if filters["modification_types"] is not None:
+        condition &= Q(facts__modification_type__in=filters["modification_types"])
+
+    # Files for which a metadata has not been computed are never filtered out by it, so the
+    # files are kept unless they have a value contradicting the filter
+    for short_name, value in filters["ternary"].items():
+        if value:
+            condition &= Q(
+                pk__in=datafiles_with_property(short_name, Q(bool_value=True))
+            )
+        else:
+            condition &= ~Q(
+                pk__in=datafiles_with_property(short_name, Q(bool_value=True))
+            )
+
+    for short_name, (min_value, max_value) in filters["range"].items():
+        condition &= ~Q(
+            pk__in=datafiles_with_property(
+                short_name,
+                Q(numeric_value__lt=min_value) | Q(numeric_value__gt=max_value),
+            )
+        )
+
+    return DataFile.objects.filter(condition)
+
+
+# Returns the primary keys of the data files matching the filters, in the search order
+def search_datafile_ids(filters):
+    if getattr(settings, "SEARCH_ENGINE", "database") == "columnar":
+        return get_column_store().search(filters)
+    return (
+        filter_datafiles(filters)
+        .order_by("file_name", "data_type")
+        .values_list("pk", flat=True)
+    )
+
+
+# Loads the data files with the given primary keys, keeping the order of the keys
+def hydrate_datafiles(datafile_ids, metadatas):
+    datafiles = (
+        DataFile.objects.filter(pk__in=list(datafile_ids))
+        .select_related("dataset")
+        .prefetch_related(
+            Prefetch(
+                "dataproperty_set",
+                queryset=DataProperty.objects.filter(metadata__in=metadatas),
+            )
+        )
+    )
+    datafile_per_pk = {datafile.pk: datafile for datafile in datafiles}
+    return [datafile_per_pk[pk] for pk in datafile_ids if pk in datafile_per_pk]
+
+
+# Returns the edges of the histogram bins of a slider, each bin covering whole values
+def histogram_edges(min_value, max_value):
+    num_bins = min(FACETS_HISTOGRAM_BINS, max_value - min_value + 1)
+    return np.linspace(min_value, max_value + 1, num_bins + 1).tolist()
+
+
+# Counts, in a single pass over the files matching the filters, the files per data type,
+# per modification type and per value of the ternary metadata, and the histogram of the
+# range metadata
+def count_facets(filters, ternary_names, histogram_edges):
+    if getattr(settings, "SEARCH_ENGINE", "database") == "columnar":
+        return get_column_store().facets(filters, ternary_names, histogram_edges)
+
+    facets = {
+        "total": 0,
+        "data_types": {t[0]: 0 for t in DATATYPES},
+        "modification_types": {mt[0]: 0 for mt in MODIFICATIONTYPES},
+        "ternary": {short_name: 0 for short_name in ternary_names},
+        "histograms": {},
+    }
+    range_values = {short_name: [] for short_name in histogram_edges}
+    rows = filter_datafiles(filters).values_list(
+        "facts__data_type", "facts__modification_type", "facts__values"
+    )
+    for data_type, modification_type, values in rows.iterator():
+        facets["total"] += 1
+        facets["data_types"][data_type] = facets["data_types"].get(data_type, 0) + 1
+        facets["modification_types"][modification_type] = (
+            facets["modification_types"].get(modification_type, 0) + 1
+        )
+        for short_name in ternary_names:
+            if values.get(short_name) is True:
+                facets["ternary"][short_name] += 1
+        for short_name, range_value in range_values.items():
+            if values.get(short_name) is not None:
+                range_value.append(values[short_name])
+    for short_name, edges in histogram_edges.items():
+        facets["histograms"][short_name] = np.histogram(
+            range_values[short_name], edges
+        )[0].tolist()
+    return facets
+
+
+# Returns the facet counts of the search, cached per normalized filters and data stamp
+def get_search_facets(filters, metadatas, slider_values):
+    ternary_names = [m.short_name for m in metadatas if m.search_widget == "ternary"]
+    edges = {
+        m.short_name: histogram_edges(values[0], values[2])
+        for m, values in slider_values.items()
+        if m in metadatas
+    }
+    normalized = json.dumps(
+        [filters, ternary_names, edges, get_data_stamp()], sort_keys=True, default=str
+    )
+    cache_key = "search-facets-" + hashlib.md5(normalized.encode()).hexdigest()
+    facets = cache.get(cache_key)
+    if facets is None:
+        facets = count_facets(filters, ternary_names, edges)
+        cache.set(cache_key, facets, FACETS_CACHE_TIME)
+
+    # Preparing the display: number of files left by each answer, bars of the histograms
+    facets["ternary"] = {
+        short_name: {"yes": num_yes, "no": facets["total"] - num_yes}
+        for short_name, num_yes in facets["ternary"].items()
+    }
+    histograms = {}
+    for short_name, counts in facets["histograms"].items():
+        max_count = max(counts + [1])
+        histograms[short_name] = [
+            {
+                "count": count,
+                "height": round(100 * count / max_count),
+                "low": ceil(edges[short_name][i]),
+                "high": ceil(edges[short_name][i + 1]) - 1,
+            }
+            for i, count in enumerate(counts)
+        ]
+    facets["histograms"] = histograms
+    return facets
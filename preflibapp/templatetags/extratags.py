@@ -8,6 +8,6 @@ def key_value(d, key):
     return d.get(key)
 
 
-@register.filter
-def get_prop_from_file(query_set, metadata):
-    return query_set.get(metadata=metadata)
+@register.simple_tag
+def matrix_cell(matrix, row, column):
+    return matrix.get(row, {}).get(column)
@@ -0,0 +1,189 @@
+from django.core import management
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from preflibapp.models import *
+from preflibapp.search import filter_datafiles
+
+from io import StringIO
+
+# The pages are not cached so that every request actually runs its queries
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+
+
+# Creates a dataset with num_files data files and their basic metadata, the first file having
+# num_related related files
+def create_dataset(series_number, num_files, num_related=0):
+    today = timezone.now().date()
+    abbreviation = "tst" + series_number
+    dataset = DataSet.objects.create(
+        name="Test dataset " + series_number,
+        abbreviation=abbreviation,
+        series_number=series_number,
+        publication_date=today,
+        modification_date=today,
+    )
+    metadata = {
+        m.short_name: m
+        for m in Metadata.objects.filter(
+            short_name__in=["numAlt", "numVot", "isStrict"]
+        )
+    }
+    datafiles = []
+    for index in range(1, num_files + 1):
+        file_name = "{}-{:08d}.{}".format(
+            series_number, index, "soc" if index % 2 else "toi"
+        )
+        datafile = DataFile.objects.create(
+            dataset=dataset,
+            file_name=file_name,
+            data_type=file_name[-3:],
+            modification_type="original",
+            file_path="data/{}/{}".format(abbreviation, file_name),
+            publication_date=today,
+            modification_date=today,
+        )
+        for short_name, value in (
+            ("numAlt", index % 7 + 2),
+            ("numVot", index * 10),
+            ("isStrict", index % 2 == 1),
+        ):
+            DataProperty.objects.create(
+                datafile=datafile, metadata=metadata[short_name], value=str(value)
+            )
+        datafiles.append(datafile)
+    for index in range(1, num_related + 1):
+        file_name = "{}-{:08d}-related{}.dat".format(series_number, 1, index)
+        DataFile.objects.create(
+            dataset=dataset,
+            file_name=file_name,
+            data_type="dat",
+            modification_type="original",
+            file_path="data/{}/{}".format(abbreviation, file_name),
+            relates_to=datafiles[0],
+            publication_date=today,
+            modification_date=today,
+        )
+    return dataset
+
+
+def update_search_tables():
+    management.call_command("updatesearchfacts", all=True, stdout=StringIO())
+    management.call_command("updatesearchbounds", stdout=StringIO())
+
+
+@override_settings(CACHES=NO_CACHE, SEARCH_ENGINE="database")
+class DataSearchQueriesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        management.call_command("initializedb", stdout=StringIO())
+
+    # The number of queries of the results page does not depend on the size of the corpus
+    def test_constant_number_of_queries(self):
+        create_dataset("00001", 3)
+        update_search_tables()
+        for query in ("", "?socselector=yes"):
+            with self.assertNumQueries(9):
+                response = self.client.get("/data/search" + query)
+            self.assertEqual(response.status_code, 200)
+
+        create_dataset("00002", 60)
+        update_search_tables()
+        for query in ("", "?socselector=yes"):
+            with self.assertNumQueries(9):
+                response = self.client.get("/data/search" + query)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["paginator"].count, 32)
+
+
+@override_settings(CACHES=NO_CACHE, SEARCH_ENGINE="database")
+class SearchRangeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        management.call_command("initializedb", stdout=StringIO())
+        # The numbers of voters are 10, 20 and 30
+        create_dataset("00001", 3)
+        update_search_tables()
+
+    def search_count(self, query):
+        response = self.client.get("/data/search?" + query, follow=True)
+        return response.context["paginator"].count
+
+    # A range outside of the slider or inverted selects no file, it is not moved onto a bound
+    def test_range_without_values(self):
+        self.assertEqual(
+            self.search_count("numVot_slider_value_min=1&numVot_slider_value_max=3"), 0
+        )
+        self.assertEqual(
+            self.search_count("numVot_slider_value_min=30&numVot_slider_value_max=10"),
+            0,
+        )
+
+    def test_range_overlapping_the_slider(self):
+        self.assertEqual(
+            self.search_count("numVot_slider_value_min=0&numVot_slider_value_max=20"), 2
+        )
+        self.assertEqual(
+            self.search_count("numVot_slider_value_min=0&numVot_slider_value_max=99"), 3
+        )
+
+
+class SearchNotComputedTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        management.call_command("initializedb", stdout=StringIO())
+        # The numbers of voters are 10, 20 and 30, the files 1 and 3 are strict
+        create_dataset("00001", 3)
+        DataProperty.objects.filter(
+            datafile__file_name="00001-00000002.toi", metadata__short_name="numVot"
+        ).delete()
+        DataProperty.objects.filter(
+            datafile__file_name="00001-00000003.soc", metadata__short_name="isStrict"
+        ).delete()
+        update_search_tables()
+
+    def filter_count(self, ternary=None, ranges=None):
+        filters = {
+            "data_types": ["soc", "toi"],
+            "modification_types": None,
+            "ternary": ternary or {},
+            "range": ranges or {},
+        }
+        return filter_datafiles(filters).count()
+
+    # A file is not filtered out by a metadata that has not been computed on it
+    def test_missing_values_are_kept(self):
+        self.assertEqual(self.filter_count(ranges={"numVot": (25, 30)}), 2)
+        self.assertEqual(self.filter_count(ternary={"isStrict": False}), 2)
+        self.assertEqual(self.filter_count(ternary={"isStrict": True}), 1)
+
+
+@override_settings(CACHES=NO_CACHE)
+class DatasetViewQueriesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        management.call_command("initializedb", stdout=StringIO())
+        create_dataset("00001", 2)
+        create_dataset("00002", 80, num_related=5)
+
+    # The number of queries of a dataset page does not depend on the size of the dataset: 4
+    # for the validators and the cache key, 5 for the page itself
+    def test_constant_number_of_queries(self):
+        for series_number in ("00001", "00002"):
+            with self.assertNumQueries(9):
+                response = self.client.get("/dataset/" + series_number)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["num_files"], 85)
+
+
+@override_settings(CACHES=NO_CACHE)
+class DataFileLinesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        management.call_command("initializedb", stdout=StringIO())
+        create_dataset("00001", 1)
+
+    # A data file missing from the static folder is not found, it is not a server error
+    def test_missing_file(self):
+        response = self.client.get("/data/lines/00001-00000001.soc")
+        self.assertEqual(response.status_code, 404)
@@ -30,6 +30,15 @@ urlpatterns = [
         distill_file="dataset/{dataset_num}.html",
     ),
     distill_re_path(r"^data/search/?$", views.data_search, name="data-search"),
+    re_path(r"^data/search\.json$", views.data_search_api, name="data-search-api"),
+    re_path(
+        r"^statistics\.json$", views.site_statistics_api, name="site-statistics-api"
+    ),
+    re_path(
+        r"^data/lines/(?P<file_name>[^/]+)$",
+        views.data_file_lines,
+        name="data-file-lines",
+    ),
     distill_re_path(
         r"^BoSc22/?$",
         views.boehmer_schaar,
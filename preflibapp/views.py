@@ -2,20 +2,44 @@ import datetime
 
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponseRedirect, Http404
-from django.views.decorators.cache import cache_page
-from django.db.models import Sum, Max, Min
+from django.urls import reverse
+from django.http import (
+    HttpResponseRedirect,
+    Http404,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.templatetags.static import static
 from django.contrib.staticfiles import finders
-from django.db.models.functions import Cast
+from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
+from django.db.models import (
+    Count,
+    F,
+    Max,
+    Q,
+    Window,
+    Prefetch,
+    prefetch_related_objects,
+)
+from django.db.models.functions import RowNumber
 from django.core.paginator import Paginator
 
-from math import floor, ceil
-
-import copy
+import base64
+import json
 import os
 
 from .models import *
 from .forms import *
+from .search import *
+from .scripts import read_line_window
+from .generations import (
+    cache_per_generation,
+    dataset_generation_key,
+    get_generation,
+    get_generation_state,
+    get_templates_state,
+)
 
 # ========================
 #   Auxiliary functions
@@ -23,6 +47,7 @@ from .forms import *
 
 CACHE_TIME = 60 * 60 * 24 * 30
 MAX_FILE_DISPLAYED = 150
+METADATA_CATEGORY_NAMES = dict(METADATACATEGORIES)
 
 
 # Returns a nice paginator of the iterable for a give window size around the current page
@@ -59,6 +84,69 @@ def get_paginator(request, iterable, page_size=20, window_size=3, max_pages=15):
     return paginator, paginated, page, pages_before, pages_after
 
 
+# ==========================================
+#   Validators of the conditional requests
+# ==========================================
+
+# They are computed from the generations and the modification dates, without rendering
+# the page. The query string is part of the ETag as it changes the content of the page.
+
+
+def latest_modification(*dates):
+    datetimes = []
+    for date in dates:
+        if date is None:
+            continue
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime.combine(
+                date, datetime.time(), tzinfo=datetime.timezone.utc
+            )
+        datetimes.append(date)
+    return max(datetimes, default=None)
+
+
+# The validators change with the data and with the templates, so that a deployment changing
+# the pages is not answered with 304
+def data_etag(request, *args, **kwargs):
+    return "data-{}-{}-{}".format(
+        get_generation(), get_templates_state()[0][:16], request.GET.urlencode()
+    )
+
+
+def data_last_modified(request, *args, **kwargs):
+    return latest_modification(
+        DataSet.objects.aggregate(Max("modification_date"))["modification_date__max"],
+        get_generation_state()[1],
+        get_templates_state()[1],
+    )
+
+
+def dataset_etag(request, dataset_num):
+    return "dataset-{}-{}-{}-{}".format(
+        dataset_num,
+        get_generation(dataset_generation_key(dataset_num)),
+        get_templates_state()[0][:16],
+        request.GET.urlencode(),
+    )
+
+
+def dataset_last_modified(request, dataset_num):
+    dataset = (
+        DataSet.objects.filter(series_number=dataset_num)
+        .annotate(files_modification_date=Max("files__modification_date"))
+        .values("modification_date", "files_modification_date")
+        .first()
+    )
+    if dataset is None:
+        return None
+    return latest_modification(
+        dataset["modification_date"],
+        dataset["files_modification_date"],
+        get_generation_state(dataset_generation_key(dataset_num))[1],
+        get_templates_state()[1],
+    )
+
+
 # ============
 #   Renderer
 # ============
@@ -97,21 +185,25 @@ def error_500_view(request):
 # =========
 
 
-@cache_page(CACHE_TIME)
+@condition(etag_func=data_etag, last_modified_func=data_last_modified)
+@cache_per_generation(CACHE_TIME)
 def main(request):
-    nb_dataset = DataSet.objects.count()
-    nb_datafile = DataFile.objects.count()
-    total_size = DataFile.objects.aggregate(Sum("file_size"))["file_size__sum"]
-    nb_datatype = DataFile.objects.values("data_type").distinct().count()
-
-    (paginator, papers, page, pages_before, pages_after) = get_paginator(
+    # The statistics are maintained by the commands that modify the data
+    statistics = SiteStatistics.objects.first() or SiteStatistics()
+    nb_dataset = statistics.num_datasets
+    nb_datafile = statistics.num_datafiles
+    total_size = statistics.total_size
+    nb_datatype = statistics.num_datatypes
+
+    paginator, papers, page, pages_before, pages_after = get_paginator(
         request, Paper.objects.all(), page_size=15
     )
 
     return my_render(request, os.path.join("preflib", "index.html"), locals())
 
 
-@cache_page(CACHE_TIME)
+@condition(etag_func=data_etag, last_modified_func=data_last_modified)
+@cache_per_generation(CACHE_TIME)
 def data_format(request):
     all_tags = DataTag.objects.all()
     metadata_per_categories = [
@@ -121,208 +213,274 @@ def data_format(request):
     return my_render(request, os.path.join("preflib", "data_format.html"), locals())
 
 
-@cache_page(CACHE_TIME)
+@condition(etag_func=data_etag, last_modified_func=data_last_modified)
+@cache_per_generation(CACHE_TIME)
 def all_datasets(request):
+    max_files_displayed = 7
+    # Only the files that have no related file are listed
+    listed_files = Q(files__related_files__isnull=True)
+    datasets = (
+        DataSet.objects.annotate(
+            num_files=Count("files", filter=listed_files, distinct=True)
+        )
+        .prefetch_related("tags")
+        .order_by("name")
+    )
+
+    # The first files of each dataset, fetched at once by numbering the files within
+    # their dataset
+    first_files = {}
+    for file in (
+        DataFile.objects.filter(related_files__isnull=True)
+        .annotate(
+            rank=Window(RowNumber(), partition_by=F("dataset_id"), order_by="file_name")
+        )
+        .filter(rank__lte=max_files_displayed)
+        .only("dataset_id", "file_name", "title")
+    ):
+        first_files.setdefault(file.dataset_id, []).append(file)
+
     tags = set()
-    datasets = DataSet.objects.filter().order_by("name")
     dataset_info = []
     for ds in datasets:
-        max_files_displayed = 7
-        files = list(ds.files.filter(related_files__isnull=True))
+        ds_tags = ds.tags.all()
         dataset_info.append(
             {
                 "ds": ds,
                 "timestamp": (ds.publication_date - datetime.date(2000, 1, 1)).days,
-                "files": files[:max_files_displayed],
-                "num_files": len(files),
-                "num_hidden_files": max(0, len(files) - max_files_displayed),
+                "files": first_files.get(ds.pk, []),
+                "num_files": ds.num_files,
+                "num_hidden_files": max(0, ds.num_files - max_files_displayed),
                 "zip_file": ds.zip_file_path,
                 "zip_file_size": ds.zip_file_size,
-                "tags": ",".join(ds.tags.values_list("name", flat=True)),
+                "tags": ",".join(tag.name for tag in ds_tags),
             }
         )
-        for tag in ds.tags.all():
-            tags.add(tag)
+        tags.update(ds_tags)
     return my_render(request, os.path.join("preflib", "dataset_all.html"), locals())
 
 
-@cache_page(CACHE_TIME)
+@condition(etag_func=dataset_etag, last_modified_func=dataset_last_modified)
+@cache_per_generation(CACHE_TIME, dataset_kwarg="dataset_num")
 def dataset_view(request, dataset_num):
-    dataset = get_object_or_404(DataSet, series_number=dataset_num)
-    data_files = dataset.files.all()
-    num_files = data_files.count()
-    total_size = data_files.aggregate(Sum("file_size"))["file_size__sum"]
-    all_types = data_files.order_by("data_type").values_list("data_type").distinct()
+    dataset = get_object_or_404(
+        DataSet.objects.prefetch_related("tags"), series_number=dataset_num
+    )
+    data_files = list(dataset.files.defer("line_index"))
+    num_files = len(data_files)
+    total_size = sum(file.file_size for file in data_files)
+    all_types = [(t,) for t in sorted(set(file.data_type for file in data_files))]
 
-    files_info = []
+    displayed_files = []
     extra_files = []
     for file in data_files:
-        if file.relates_to is None:
-            if len(files_info) > MAX_FILE_DISPLAYED:
+        if file.relates_to_id is None:
+            if len(displayed_files) > MAX_FILE_DISPLAYED:
                 extra_files.append(file)
             else:
-                file_dict = {"f": file}
-                # Getting the metadata value for each category
-                meta_per_category = {}
-                for prop in file.dataproperty_set.all():
-                    category_long_name = find_choice_value(
-                        METADATACATEGORIES, prop.metadata.category
-                    )
-                    if category_long_name in meta_per_category:
-                        meta_per_category[category_long_name].append(prop)
-                    else:
-                        meta_per_category[category_long_name] = [prop]
-                    if prop.metadata.short_name == "numAlt":
-                        file_dict["num_alt"] = prop.typed_value()
-                    if prop.metadata.short_name == "numVot":
-                        file_dict["num_vot"] = prop.typed_value()
-                file_dict["meta_per_cat"] = meta_per_category
-                # Getting the first few lines of the file
-                meta_lines = []
-                pref_lines = []
-                global_index = 0
-                meta_index = 1
-                pref_index = 1
-                with open(finders.find(file.file_path), "r", encoding="utf-8") as f:
-                    for line in f.readlines():
-                        global_index += 1
-                        if line.startswith("#"):
-                            if meta_index is not None:
-                                if meta_index <= 15:
-                                    meta_lines.append((global_index, line.strip()))
-                                    meta_index += 1
-                                else:
-                                    meta_lines.append(("...", "..."))
-                                    meta_index = None
-                        else:
-                            if pref_index <= 10:
-                                pref_lines.append(
-                                    (global_index, line.strip().replace(",", ", "))
-                                )
-                                pref_index += 1
-                            else:
-                                pref_lines.append(("...", "..."))
-                                break
-                lines = meta_lines + pref_lines
-                file_dict["preview"] = lines
-                files_info.append(file_dict)
+                displayed_files.append(file)
+    # The properties and the related files are only fetched for the displayed files
+    prefetch_related_objects(
+        displayed_files,
+        Prefetch(
+            "dataproperty_set",
+            queryset=DataProperty.objects.select_related("metadata"),
+        ),
+        Prefetch("related_files", queryset=DataFile.objects.defer("line_index")),
+    )
+
+    files_info = []
+    for file in displayed_files:
+        file_dict = {"f": file}
+        # Getting the metadata value for each category
+        meta_per_category = {}
+        for prop in file.dataproperty_set.all():
+            category_long_name = METADATA_CATEGORY_NAMES.get(prop.metadata.category)
+            if category_long_name in meta_per_category:
+                meta_per_category[category_long_name].append(prop)
+            else:
+                meta_per_category[category_long_name] = [prop]
+            if prop.metadata.short_name == "numAlt":
+                file_dict["num_alt"] = prop.typed_value()
+            if prop.metadata.short_name == "numVot":
+                file_dict["num_vot"] = prop.typed_value()
+        file_dict["meta_per_cat"] = meta_per_category
+        # The first few lines of the file are extracted when it is added
+        file_dict["preview"] = file.preview
+        files_info.append(file_dict)
     return my_render(request, os.path.join("preflib", "dataset.html"), locals())
 
 
+@cache_per_generation(CACHE_TIME)
 def data_search(request):
-    print(request.POST)
-    types = copy.deepcopy(DATATYPES)
-    types.remove(("dat", "extra data file"))
-    types.remove(("csv", "comma-separated values"))
-    modification_types = MODIFICATIONTYPES
-    metadatas = Metadata.objects.filter(is_active=True, is_displayed=True)
-
-    metadata_slider_values = {}
-    remove_metadata = []
-    # We compute the max and min values of the slider for each metadata
-    for m in metadatas:
-        if m.search_widget == "range":
-            props = DataProperty.objects.filter(metadata=m)
-            if props.exists():
-                props = props.annotate(float_value=Cast("value", models.FloatField()))
-                max_value = ceil(
-                    props.aggregate(Max("float_value"))["float_value__max"]
-                )
-                min_value = floor(
-                    props.aggregate(Min("float_value"))["float_value__min"]
-                )
-                intermediate_value = (
-                    floor((max_value - min_value) * 0.3)
-                    if max_value > 30
-                    else floor((max_value - min_value) * 0.5)
-                )
-                metadata_slider_values[m] = (min_value, intermediate_value, max_value)
-
-                # If the min and max are equal, filtering on that metadata is useless so we remove it
-                if max_value == min_value:
-                    remove_metadata.append(m)
-            else:
-                remove_metadata.append(m)
+    types, modification_types, metadatas, metadata_slider_values = get_search_widgets()
 
-    for m in remove_metadata:
-        metadatas = metadatas.exclude(pk=m.pk)
+    # The search is encoded canonically in the query string, so that equivalent searches
+    # share a single URL (and a single cache entry)
+    search_params = canonical_search_params(
+        request.GET, types, modification_types, metadatas, metadata_slider_values
+    )
+    try:
+        page = max(1, int(request.GET.get("page", 1)))
+    except ValueError:
+        page = 1
+    canonical_query = canonical_search_query(search_params, page)
+    if request.META.get("QUERY_STRING", "") != canonical_query:
+        search_url = reverse("preflibapp:data-search")
+        if canonical_query:
+            search_url += "?" + canonical_query
+        return HttpResponseRedirect(search_url)
+    paginator_query = canonical_search_query(search_params)
+
+    search_filters = parse_search_filters(
+        search_params, types, modification_types, metadatas
+    )
+    all_files = search_datafile_ids(search_filters)
+    facets = get_search_facets(search_filters, metadatas, metadata_slider_values)
+    paginator, datafiles, page, pages_before, pages_after = get_paginator(
+        request, all_files, page_size=40
+    )
+    # Only the files of the current page are loaded from the database
+    datafiles.object_list = hydrate_datafiles(datafiles.object_list, metadatas)
+
+    # Pivoting the properties of the displayed files into {file_pk: {metadata_pk: value}}
+    metadata_per_pk = {m.pk: m for m in metadatas}
+    property_matrix = {}
+    for file in datafiles:
+        property_matrix[file.pk] = {}
+        for prop in file.dataproperty_set.all():
+            prop.metadata = metadata_per_pk[prop.metadata_id]
+            property_matrix[file.pk][prop.metadata_id] = prop.typed_value()
+    return my_render(request, os.path.join("preflib", "datasearch.html"), locals())
 
-    print(metadatas)
 
-    # This is to save the POST data when we change to a different page of the results
-    if request.method != "POST" and "page" in request.GET:
-        if "search_datafiles_POST" in request.session:
-            request.POST = request.session["search_datafiles_POST"]
-            request.method = "POST"
+# Fields of the records returned by the search API, and where to find them
+SEARCH_API_FIELDS = {
+    "file_name": "file_name",
+    "dataset": "dataset__series_number",
+    "data_type": "data_type",
+    "modification_type": "modification_type",
+    "title": "title",
+    "description": "description",
+    "file_size": "file_size",
+    "url": "file_path",
+    "metadata": "facts__values",
+}
+SEARCH_API_PAGE_SIZE = 1000
+SEARCH_API_MAX_PAGE_SIZE = 10000
+
+LINE_WINDOW_SIZE = 100
+LINE_WINDOW_MAX_SIZE = 10000
+
+
+# The cursor of the search API encodes the (file_name, data_type) key of the last record sent
+def encode_search_cursor(file_name, data_type):
+    return base64.urlsafe_b64encode(
+        json.dumps([file_name, data_type]).encode()
+    ).decode()
+
+
+def decode_search_cursor(cursor):
+    file_name, data_type = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return str(file_name), str(data_type)
+
+
+# Streams the JSON of the search API, the extra row fetched after the last one tells
+# whether there is a next page
+def stream_search_records(rows, fields, page_size):
+    yield '{"results": ['
+    next_cursor = None
+    for index, row in enumerate(rows.iterator(chunk_size=500)):
+        if index == page_size:
+            next_cursor = encode_search_cursor(*previous_key)
+            break
+        record = dict(zip(fields, row))
+        if "url" in record:
+            record["url"] = static(record["url"])
+        yield ("," if index > 0 else "") + json.dumps(record)
+        previous_key = row[-2:]
+    yield '], "next": ' + json.dumps(next_cursor) + "}"
+
+
+def data_search_api(request):
+    types, modification_types, metadatas, metadata_slider_values = get_search_widgets()
+    search_params = canonical_search_params(
+        request.GET, types, modification_types, metadatas, metadata_slider_values
+    )
+    search_filters = parse_search_filters(
+        search_params, types, modification_types, metadatas
+    )
 
-    all_files = DataFile.objects.filter(data_type__in=[t[0] for t in types])
-    if request.method == "POST":
-        request.session["search_datafiles_POST"] = request.POST
-
-        datatype_filter = [t[0] for t in types]
-        for t in types:
-            if request.POST.get(t[0] + "selector") == "no":
-                if t[0] in datatype_filter:
-                    datatype_filter.remove(t[0])
-            elif request.POST.get(t[0] + "selector") == "yes":
-                datatype_filter = [x for x in datatype_filter if x == t[0]]
-        all_files = all_files.filter(data_type__in=datatype_filter)
-
-        modiftype_filer = [mt[0] for mt in modification_types]
-        for mt in modification_types:
-            if request.POST.get(mt[0] + "selector") == "no":
-                if mt[0] in modiftype_filer:
-                    modiftype_filer.remove(mt[0])
-            elif request.POST.get(mt[0] + "selector") == "yes":
-                modiftype_filer = [x for x in modiftype_filer if x == mt[0]]
-        all_files = all_files.filter(modification_type__in=modiftype_filer)
-
-        for m in metadatas:
-            if m.search_widget == "ternary":
-                if request.POST.get(m.short_name + "selector") == "no":
-                    property_query = DataProperty.objects.filter(metadata=m, value=True)
-                    all_files = all_files.exclude(
-                        dataproperty__in=models.Subquery(property_query.values("pk"))
-                    )
-                elif request.POST.get(m.short_name + "selector") == "yes":
-                    property_query = DataProperty.objects.filter(metadata=m, value=True)
-                    all_files = all_files.filter(
-                        dataproperty__in=models.Subquery(property_query.values("pk"))
-                    )
-
-            elif m.search_widget == "range":
-                print(m.short_name)
-                property_query_min = (
-                    DataProperty.objects.filter(metadata=m)
-                    .annotate(float_value=Cast("value", models.FloatField()))
-                    .filter(
-                        float_value__lt=float(
-                            request.POST.get(m.short_name + "_slider_value_min")
-                        )
-                    )
-                )
-                all_files = all_files.exclude(
-                    dataproperty__in=models.Subquery(property_query_min.values("pk"))
-                )
-                property_query_max = (
-                    DataProperty.objects.filter(metadata=m)
-                    .annotate(float_value=Cast("value", models.FloatField()))
-                    .filter(
-                        float_value__gt=float(
-                            request.POST.get(m.short_name + "_slider_value_max")
-                        )
-                    )
-                )
-
-                all_files = all_files.exclude(
-                    dataproperty__in=models.Subquery(property_query_max.values("pk"))
-                )
-
-    all_files = all_files.order_by("file_name", "data_type")
-    (paginator, datafiles, page, pages_before, pages_after) = get_paginator(
-        request, all_files, page_size=40
+    fields = request.GET.get("fields")
+    fields = fields.split(",") if fields else list(SEARCH_API_FIELDS)
+    for field in fields:
+        if field not in SEARCH_API_FIELDS:
+            return JsonResponse({"error": "Unknown field " + field}, status=400)
+    try:
+        page_size = int(request.GET.get("limit", SEARCH_API_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({"error": "The limit should be an integer"}, status=400)
+    page_size = max(1, min(page_size, SEARCH_API_MAX_PAGE_SIZE))
+
+    # Keyset pagination: we continue right after the key of the cursor
+    datafiles = filter_datafiles(search_filters).order_by("file_name", "data_type")
+    if request.GET.get("cursor"):
+        try:
+            file_name, data_type = decode_search_cursor(request.GET["cursor"])
+        except (ValueError, TypeError):
+            return JsonResponse({"error": "Invalid cursor"}, status=400)
+        datafiles = datafiles.filter(
+            Q(file_name__gt=file_name) | Q(file_name=file_name, data_type__gt=data_type)
+        )
+
+    rows = datafiles.values_list(
+        *[SEARCH_API_FIELDS[field] for field in fields], "file_name", "data_type"
+    )[: page_size + 1]
+    return StreamingHttpResponse(
+        stream_search_records(rows, fields, page_size),
+        content_type="application/json",
+    )
+
+
+def site_statistics_api(request):
+    statistics = SiteStatistics.objects.first() or SiteStatistics()
+    return JsonResponse(
+        {
+            "num_datasets": statistics.num_datasets,
+            "num_datafiles": statistics.num_datafiles,
+            "total_size": statistics.total_size,
+            "num_datatypes": statistics.num_datatypes,
+            "files_per_type": statistics.files_per_type,
+            "updated_at": statistics.updated_at,
+        }
+    )
+
+
+# Returns a window of lines of a data file, the line index of the file allows to read only
+# the lines of the window
+@cache_per_generation(CACHE_TIME)
+def data_file_lines(request, file_name):
+    datafile = get_object_or_404(DataFile, file_name=file_name)
+    try:
+        start = max(1, int(request.GET.get("start", 1)))
+        count = int(request.GET.get("count", LINE_WINDOW_SIZE))
+    except ValueError:
+        return JsonResponse(
+            {"error": "The start and the count should be integers"}, status=400
+        )
+    count = max(1, min(count, LINE_WINDOW_MAX_SIZE))
+    file_path = finders.find(datafile.file_path)
+    if file_path is None:
+        raise Http404("The data file {} was not found".format(datafile.file_name))
+    lines = read_line_window(file_path, datafile.line_index, start, count)
+    return JsonResponse(
+        {
+            "file_name": datafile.file_name,
+            "num_lines": datafile.num_lines,
+            "start": start,
+            "lines": lines,
+        }
     )
-    return my_render(request, os.path.join("preflib", "datasearch.html"), locals())
 
 
 @cache_page(CACHE_TIME)
@@ -355,9 +513,9 @@ def tools_CRIS(request):
 
 
 # Paper views
-@cache_page(CACHE_TIME)
+@cache_per_generation(CACHE_TIME)
 def papers(request):
-    (paginator, papers, page, pages_before, pages_after) = get_paginator(
+    paginator, papers, page, pages_before, pages_after = get_paginator(
         request, Paper.objects.all(), page_size=30
     )
     return my_render(request, os.path.join("preflib", "papers.html"), locals())